@@ -1,6 +1,10 @@
 
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import json
+
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Query
+
+from fastapi.concurrency import run_in_threadpool
 
 from pydantic import BaseModel
 
@@ -16,7 +20,7 @@ brain = Brain()
 
 
 
-from .memory_rag import MR
+from .memory_rag import MR, SEARCH_MODES
 
 from .mood_engine import mood_engine  
 
@@ -40,6 +44,46 @@ class MemoryAddReq(BaseModel):
 
     tags: Optional[List[str]] = None
 
+    dedup: Optional[bool] = None
+
+
+
+class MemorySearchBatchReq(BaseModel):
+
+    queries: List[str]
+
+    k: int = 5
+
+    mode: Optional[str] = None
+
+    tags: Optional[List[str]] = None
+
+    since: Optional[str] = None
+
+    until: Optional[str] = None
+
+    half_life_days: Optional[float] = None
+
+    mmr_lambda: Optional[float] = None
+
+
+
+class MemoryDeleteWhereReq(BaseModel):
+
+    substring: Optional[str] = None
+
+    tags: Optional[List[str]] = None
+
+    since: Optional[str] = None
+
+    until: Optional[str] = None
+
+    ids: Optional[List[str]] = None
+
+    limit: Optional[int] = None
+
+    dry_run: bool = False
+
 
 
 class ApprovalReq(BaseModel):
@@ -80,33 +124,189 @@ async def chat(req: ChatRequest):
 
 @app.get("/memories/search")
 
-async def memories_search(q: str, k: int = 5):
+async def memories_search(q: str, k: int = 5, mode: Optional[str] = None, tags: Optional[List[str]] = Query(None),
+
+                          since: Optional[str] = None, until: Optional[str] = None, half_life_days: Optional[float] = None,
+
+                          mmr_lambda: Optional[float] = None):
+
+    log_action("api_request", {"endpoint": "/memories/search", "query_len": len(q), "mode": mode, "tags": tags or []})
+
+    if mode is not None and mode not in SEARCH_MODES:
+
+        raise HTTPException(400, f"mode must be one of {', '.join(SEARCH_MODES)}")
 
-    log_action("api_request", {"endpoint": "/memories/search", "query_len": len(q)})
+    try:
+
+        return {"results": MR.search(q, k=k, mode=mode, tags=tags, since=since, until=until, half_life_days=half_life_days,
+
+                                     mmr_lambda=mmr_lambda)}
+
+    except ValueError as e:
+
+        raise HTTPException(400, str(e))
+
+
+
+@app.post("/memories/search_batch")
+
+async def memories_search_batch(req: MemorySearchBatchReq):
+
+    log_action("api_request", {"endpoint": "/memories/search_batch", "queries": len(req.queries), "mode": req.mode})
+
+    if req.mode is not None and req.mode not in SEARCH_MODES:
+
+        raise HTTPException(400, f"mode must be one of {', '.join(SEARCH_MODES)}")
+
+    try:
+
+        results = await run_in_threadpool(MR.search_many, req.queries, req.k, req.mode, req.tags, req.since, req.until, req.half_life_days,
+
+                                           req.mmr_lambda)
 
-    return {"results": MR.search(q, k=k)}
+    except ValueError as e:
+
+        raise HTTPException(400, str(e))
+
+    return {"results": results}
 
 
 
 @app.post("/memories/add")
 
-async def memories_add(req: MemoryAddReq):
+async def memories_add(req: MemoryAddReq, include_embedding: bool = False):
 
     log_action("api_request", {"endpoint": "/memories/add", "text_len": len(req.text)})
 
-    e = MR.add_memory(req.text, tags=req.tags)
+    e = MR.add_memory(req.text, tags=req.tags, dedup=req.dedup)
+
+    return {"ok": True, "entry": e.to_dict(include_embedding)}
+
+
+
+async def _ndjson_lines(request: Request):
+
+    buf = b""
+
+    async for chunk in request.stream():
+
+        buf += chunk
+
+        *lines, buf = buf.split(b"\n")
+
+        for line in lines:
+
+            yield line
+
+    yield buf
+
+
 
-    return {"ok": True, "entry": e.to_dict()}
+def _bulk_item(line: bytes):
+
+    item = json.loads(line)
+
+    text = item.get("text")
+
+    if not (isinstance(text, str) and text.strip()):
+
+        raise ValueError("text must be a non-empty string")
+
+    tags = item.get("tags")
+
+    if tags is not None and not (isinstance(tags, list) and all(isinstance(t, str) for t in tags)):
+
+        raise ValueError("tags must be a list of strings")
+
+    meta = {k: item[k] for k in ("id", "created_at", "importance") if item.get(k) is not None}
+
+    if "id" in meta:
+
+        meta["id"] = str(meta["id"])
+
+    if "importance" in meta:
+
+        meta["importance"] = min(1.0, max(0.0, float(meta["importance"])))
+
+    return text, tags, meta
+
+
+
+async def _add_pending(pending: List[tuple], batch_size: int) -> int:
+
+    texts, tags, metas = (list(col) for col in zip(*pending))
+
+    entries = await run_in_threadpool(MR.add_memories, texts, tags, metas, batch_size)
+
+    return len(entries)
+
+
+
+@app.post("/memories/bulk_add")
+
+async def memories_bulk_add(request: Request, batch_size: int = 256):
+
+    log_action("api_request", {"endpoint": "/memories/bulk_add"})
+
+    batch_size = max(1, batch_size)
+
+    pending: List[tuple] = []
+
+    added, batches, errors = 0, 0, 0
+
+    async for line in _ndjson_lines(request):
+
+        if not line.strip():
+
+            continue
+
+        try:
+
+            pending.append(_bulk_item(line))
+
+        except Exception:
+
+            errors += 1
+
+            continue
+
+        if len(pending) >= batch_size:
+
+            added += await _add_pending(pending, batch_size)
+
+            batches += 1
+
+            pending = []
+
+    if pending:
+
+        added += await _add_pending(pending, batch_size)
+
+        batches += 1
+
+    log_action("api_response", {"endpoint": "/memories/bulk_add", "added": added, "errors": errors})
+
+    return {"ok": True, "added": added, "batches": batches, "errors": errors}
 
 
 
 @app.get("/memories/list")
 
-async def memories_list(limit: int = 50):
+async def memories_list(limit: int = 50, include_embedding: bool = False, cursor: Optional[str] = None,
+
+                        tags: Optional[List[str]] = Query(None)):
 
     log_action("api_request", {"endpoint": "/memories/list"})
 
-    return {"count": len(MR.list_memories()), "memories": MR.list_memories(limit=limit)}
+    try:
+
+        memories, next_cursor = MR.list_page(limit, cursor, tags, include_embedding)
+
+    except ValueError as e:
+
+        raise HTTPException(400, str(e))
+
+    return {"count": MR.count(tags), "memories": memories, "next_cursor": next_cursor}
 
 
 
@@ -120,6 +320,24 @@ async def memories_delete(id: str):
 
     return {"deleted": ok}
 
+
+
+@app.post("/memories/delete_where")
+
+async def memories_delete_where(req: MemoryDeleteWhereReq):
+
+    log_action("api_request", {"endpoint": "/memories/delete_where", "dry_run": req.dry_run})
+
+    try:
+
+        n = await run_in_threadpool(MR.delete_where, req.substring, req.tags, req.since, req.until, req.ids, req.limit, req.dry_run)
+
+    except ValueError as e:
+
+        raise HTTPException(400, str(e))
+
+    return {"matched" if req.dry_run else "deleted": n, "count": MR.count()}
+
 @app.get("/mood")
 
 async def mood_get():
@@ -200,7 +418,9 @@ async def health():
 
     log_action("api_request", {"endpoint": "/health"})
 
-    return {"ok": True, "memory_count": len(MR.list_memories())}
+    return {"ok": True, "memory_count": MR.count(), "embed_cache": MR.embedder.cache_stats(),
+
+            "embed_service": MR.embedder.service_stats()}
 
 
 
@@ -52,6 +52,10 @@ MAX_MEMORY_SNIPPET = 150
 
 CONVERSATION_HISTORY_SIZE = 10
 
+MEMORY_HALF_LIFE_DAYS = 14.0
+
+MEMORY_MMR_LAMBDA = 0.5
+
 
 
 StreamCallback = Optional[Callable[[str], None]]
@@ -194,6 +198,14 @@ class Brain:
 
         self.memory_update_interval = 1800                 
 
+        try:
+
+            self.memory_half_life_days = float((P.get("personality") or {}).get("memory_half_life_days", MEMORY_HALF_LIFE_DAYS))
+
+        except Exception:
+
+            self.memory_half_life_days = MEMORY_HALF_LIFE_DAYS
+
 
 
         self.notify_callback: Optional[Callable[[str], None]] = lambda msg: None
@@ -206,7 +218,7 @@ class Brain:
 
         try:
 
-            memories = MR.search(user_input, k=8)
+            memories = MR.search(user_input, k=8, half_life_days=self.memory_half_life_days, mmr_lambda=MEMORY_MMR_LAMBDA)
 
                                                                                   
 
@@ -214,7 +226,7 @@ class Brain:
 
             for m in memories:
 
-                ts = m.get("timestamp") or m.get("time") or "?"
+                ts = m.get("created_at") or m.get("timestamp") or m.get("time") or "?"
 
                 text = str(m.get("text") or m.get("content") or "")[:MAX_MEMORY_SNIPPET]
 
@@ -352,7 +364,7 @@ class Brain:
 
             try:
 
-                MR.add_memory(f"Autonomy tick: current mood {self.mood.snapshot()}")
+                MR.add_memory(f"Autonomy tick: current mood {self.mood.snapshot()}", dedup=True)
 
             except Exception:
 
@@ -480,9 +492,9 @@ class Brain:
 
             try:
 
-                MR.add_memory(f"[{now_iso}] User: {user_input}")
+                MR.add_memory(f"[{now_iso}] User: {user_input}", dedup=True)
 
-                MR.add_memory(f"[{resp_time_iso}] Mainmi: {response}")
+                MR.add_memory(f"[{resp_time_iso}] Mainmi: {response}", dedup=True)
 
             except Exception:
 
@@ -0,0 +1,182 @@
+import os
+
+import sqlite3
+
+import hashlib
+
+import threading
+
+from pathlib import Path
+
+from typing import List, Optional, Dict, Any
+
+
+
+import numpy as np
+
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+EMBED_CACHE_PATH = Path(os.environ.get("MAINMI_EMBED_CACHE_PATH", str(ROOT / "db" / "embed_cache.sqlite")))
+
+EMBED_CACHE_ENABLED = os.environ.get("MAINMI_EMBED_CACHE", "1") != "0"
+
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+SQLITE_MAX_VARS = 900
+
+
+
+def text_key(text: str) -> bytes:
+
+    return hashlib.sha256(text.encode("utf-8", "surrogatepass")).digest()
+
+
+
+class EmbedCache:
+
+    """Float32 BLOBs keyed by (model, sha256(text)) in a WAL-mode SQLite file."""
+
+
+
+    def __init__(self, path: Path = EMBED_CACHE_PATH):
+
+        self.path = Path(path)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._local = threading.local()
+
+        self._lock = threading.Lock()
+
+        self.hits = 0
+
+        self.misses = 0
+
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash BLOB NOT NULL,
+                vec BLOB NOT NULL,
+                PRIMARY KEY (model, hash)
+            ) WITHOUT ROWID
+        """)
+
+
+
+    def _conn(self) -> sqlite3.Connection:
+
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+
+            conn = sqlite3.connect(str(self.path), timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None, check_same_thread=False)
+
+            conn.execute("PRAGMA journal_mode=WAL")
+
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+            self._local.conn = conn
+
+        return conn
+
+
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+
+        keys = [text_key(t) for t in texts]
+
+        found: Dict[bytes, np.ndarray] = {}
+
+        uniq = list(dict.fromkeys(keys))
+
+        for i in range(0, len(uniq), SQLITE_MAX_VARS):
+
+            chunk = uniq[i:i + SQLITE_MAX_VARS]
+
+            rows = self._conn().execute(
+
+                f"SELECT hash, vec FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})", [model, *chunk]
+
+            )
+
+            for h, blob in rows:
+
+                found[h] = np.frombuffer(blob, dtype="<f4").copy()
+
+        out = [found.get(k) for k in keys]
+
+        hit = sum(v is not None for v in out)
+
+        with self._lock:
+
+            self.hits += hit
+
+            self.misses += len(out) - hit
+
+        return out
+
+
+
+    def put_many(self, model: str, texts: List[str], vecs: np.ndarray):
+
+        rows = [(model, text_key(t), np.ascontiguousarray(v, dtype="<f4").tobytes()) for t, v in zip(texts, vecs)]
+
+        if not rows:
+
+            return
+
+        conn = self._conn()
+
+        try:
+
+            conn.execute("BEGIN IMMEDIATE")
+
+            conn.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vec) VALUES (?, ?, ?)", rows)
+
+            conn.execute("COMMIT")
+
+        except Exception:
+
+            try:
+
+                conn.execute("ROLLBACK")
+
+            except Exception:
+
+                pass
+
+
+
+    def count(self, model: Optional[str] = None) -> int:
+
+        if model is None:
+
+            return int(self._conn().execute("SELECT count(*) FROM embeddings").fetchone()[0])
+
+        return int(self._conn().execute("SELECT count(*) FROM embeddings WHERE model = ?", (model,)).fetchone()[0])
+
+
+
+    def stats(self) -> Dict[str, Any]:
+
+        with self._lock:
+
+            total = self.hits + self.misses
+
+            return {"path": str(self.path), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+
+    def close(self):
+
+        conn = getattr(self._local, "conn", None)
+
+        if conn is not None:
+
+            conn.close()
+
+            self._local.conn = None
+
+
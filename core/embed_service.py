@@ -6,14 +6,28 @@
 
 
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
 
 from pydantic import BaseModel
 
+import io
+
 import os
 
+import time
+
+import threading
+
+import multiprocessing
+
 import typing as t
 
+from collections import deque
+
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from concurrent.futures.process import BrokenProcessPool
+
 
 
 app = FastAPI(title="Mainmi Local Embed Service")
@@ -24,30 +38,66 @@ app = FastAPI(title="Mainmi Local Embed Service")
 
 try:
 
-    from sentence_transformers import SentenceTransformer
-
     import numpy as np
 
-    ST_AVAILABLE = True
+except Exception:
+
+    np = None
+
+
+
+try:
+
+    from sentence_transformers import SentenceTransformer
+
+    ST_AVAILABLE = np is not None
 
 except Exception:
 
     SentenceTransformer = None
 
-    np = None
-
     ST_AVAILABLE = False
 
 
 
+try:
+
+    from core.embed_cache import EmbedCache, EMBED_CACHE_ENABLED
+
+except Exception:
+
+    EmbedCache = None
+
+    EMBED_CACHE_ENABLED = False
+
+
+
                                       
 
-_EMBED_MODEL = None
+_CACHE = None
 
 EMBED_MODEL_NAME = os.environ.get("MAINMI_EMBED_MODEL", "all-MiniLM-L6-v2")
 
+EMBED_MODELS = [m.strip() for m in os.environ.get("MAINMI_EMBED_MODELS", EMBED_MODEL_NAME).split(",") if m.strip()] or [EMBED_MODEL_NAME]
+
+EMBED_WARMUP = os.environ.get("MAINMI_EMBED_WARMUP", "1") != "0"
+
+EMBED_MAX_BATCH = int(os.environ.get("MAINMI_EMBED_MAX_BATCH", "64"))
+
+EMBED_MAX_WAIT_MS = float(os.environ.get("MAINMI_EMBED_MAX_WAIT_MS", "5"))
+
+EMBED_WORKERS = int(os.environ.get("MAINMI_EMBED_WORKERS", "0"))
+
+EMBED_WORKER_THREADS = int(os.environ.get("MAINMI_EMBED_WORKER_THREADS", "0"))
+
+EMBED_SHARD_MIN = int(os.environ.get("MAINMI_EMBED_SHARD_MIN", "32"))
+
+BINARY_MEDIA_TYPES = ("application/x-float32", "application/x-npy")
+
 DEFAULT_DIM = 384
 
+_WORKER_MODEL = None
+
 
 
 class EmbedReq(BaseModel):
@@ -56,51 +106,549 @@ class EmbedReq(BaseModel):
 
 
 
-def _ensure_model():
+class WorkersReq(BaseModel):
+
+    replicas: int
+
+    model: t.Optional[str] = None
+
+    threads: t.Optional[int] = None
+
+
+
+def _cache():
+
+    global _CACHE
+
+    if _CACHE is None and EMBED_CACHE_ENABLED:
+
+        try:
+
+            _CACHE = EmbedCache()
+
+        except Exception:
+
+            _CACHE = None
+
+    return _CACHE
+
+
+
+def _encode(model, texts: t.List[str]):
+
+    arr = model.encode(texts, convert_to_numpy=True)
+
+    norms = (arr**2).sum(axis=1, keepdims=True)**0.5 + 1e-12
+
+    return (arr / norms).astype("float32")
+
+
+
+class MicroBatcher:
+
+    def __init__(self, encode: t.Callable[[t.List[str]], t.Any], max_batch: int = EMBED_MAX_BATCH, max_wait_ms: float = EMBED_MAX_WAIT_MS):
+
+        self.encode = encode
+
+        self.max_batch = max(1, int(max_batch))
+
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._pending: "deque[t.Tuple[t.List[str], Future]]" = deque()
+
+        self._cond = threading.Condition()
+
+        self._worker: t.Optional[threading.Thread] = None
+
+        self.batches = 0
+
+        self.requests = 0
+
+        self.texts = 0
+
+        self.encoded = 0
+
+        self.largest = 0
+
+        self.peak_depth = 0
+
+
+
+    def submit(self, texts: t.List[str]):
+
+        fut: Future = Future()
+
+        with self._cond:
+
+            self._pending.append((texts, fut))
+
+            self.peak_depth = max(self.peak_depth, len(self._pending))
+
+            if self._worker is None or not self._worker.is_alive():
+
+                self._worker = threading.Thread(target=self._run, daemon=True, name="mainmi-embed-batcher")
+
+                self._worker.start()
+
+            self._cond.notify()
+
+        return fut.result()
+
+
+
+    def _take(self) -> t.List[t.Tuple[t.List[str], Future]]:
+
+        with self._cond:
+
+            while not self._pending:
+
+                self._cond.wait()
+
+            deadline = time.monotonic() + self.max_wait
+
+            batch = [self._pending.popleft()]
+
+            size = len(batch[0][0])
+
+            while size < self.max_batch:
+
+                if not self._pending:
+
+                    left = deadline - time.monotonic()
+
+                    if left <= 0:
+
+                        break
+
+                    self._cond.wait(left)
+
+                    continue
+
+                if size + len(self._pending[0][0]) > self.max_batch:
+
+                    break
+
+                item = self._pending.popleft()
+
+                batch.append(item)
+
+                size += len(item[0])
+
+            return batch
+
+
+
+    def _run(self):
+
+        while True:
+
+            batch = self._take()
+
+            texts = [txt for item, _ in batch for txt in item]
+
+            uniq = list(dict.fromkeys(texts))
+
+            try:
+
+                arr = self.encode(uniq)
+
+            except Exception as e:
+
+                for _, fut in batch:
+
+                    fut.set_exception(e)
+
+                continue
+
+            pos = {txt: i for i, txt in enumerate(uniq)}
+
+            with self._cond:
+
+                self.batches += 1
+
+                self.requests += len(batch)
+
+                self.texts += len(texts)
+
+                self.encoded += len(uniq)
+
+                self.largest = max(self.largest, len(uniq))
+
+            for item, fut in batch:
+
+                fut.set_result(arr[[pos[txt] for txt in item]])
+
+
+
+    def stats(self) -> t.Dict[str, t.Any]:
+
+        with self._cond:
+
+            return {"queue_depth": len(self._pending), "queued_texts": sum(len(item) for item, _ in self._pending),
+
+                    "peak_depth": self.peak_depth, "batches": self.batches, "requests": self.requests, "texts": self.texts,
+
+                    "encoded": self.encoded, "largest_batch": self.largest,
+
+                    "mean_batch": self.encoded / self.batches if self.batches else 0.0,
+
+                    "max_batch": self.max_batch, "max_wait_ms": self.max_wait * 1000.0}
+
+
+
+def _worker_init(model_name: str, threads: int):
+
+    global _WORKER_MODEL
+
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+
+        os.environ[var] = str(threads)
+
+    try:
+
+        import torch
+
+        torch.set_num_threads(threads)
+
+    except Exception:
+
+        pass
+
+    _WORKER_MODEL = SentenceTransformer(model_name)
+
+
+
+def _worker_encode(texts: t.List[str]):
+
+    return _encode(_WORKER_MODEL, texts)
+
+
+
+class EncoderPool:
+
+    def __init__(self, model_name: str, replicas: int, threads: t.Optional[int] = None, shard_min: int = EMBED_SHARD_MIN):
+
+        self.model_name = model_name
+
+        self.shard_min = max(1, int(shard_min))
+
+        self.replicas = 0
+
+        self.threads = 0
+
+        self._executor: t.Optional[ProcessPoolExecutor] = None
+
+        self._lock = threading.Lock()
+
+        self.batches = 0
+
+        self.shards = 0
+
+        self.texts = 0
+
+        self.resize(replicas, threads)
+
+
+
+    def resize(self, replicas: int, threads: t.Optional[int] = None):
+
+        replicas = max(1, int(replicas))
+
+        threads = int(threads or EMBED_WORKER_THREADS or max(1, (os.cpu_count() or 1) // replicas))
+
+        executor = ProcessPoolExecutor(max_workers=replicas, mp_context=multiprocessing.get_context("spawn"),
+
+                                       initializer=_worker_init, initargs=(self.model_name, threads))
+
+        list(executor.map(_worker_encode, [["warmup"]] * replicas))
+
+        with self._lock:
+
+            old, self._executor = self._executor, executor
+
+            self.replicas, self.threads = replicas, threads
+
+        if old is not None:
+
+            old.shutdown(wait=True)
+
+
+
+    def wants(self, n: int) -> bool:
+
+        return n >= 2 * self.shard_min
+
+
+
+    def encode(self, texts: t.List[str]):
+
+        with self._lock:
+
+            parts = min(self.replicas, max(1, len(texts) // self.shard_min))
+
+            bounds = np.linspace(0, len(texts), parts + 1).astype(int)
+
+            futs = [self._executor.submit(_worker_encode, texts[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+        out = np.vstack([f.result() for f in futs])
+
+        with self._lock:
+
+            self.batches += 1
+
+            self.shards += len(futs)
+
+            self.texts += len(texts)
+
+        return out
+
+
+
+    def close(self):
+
+        with self._lock:
+
+            executor, self._executor = self._executor, None
 
-    global _EMBED_MODEL
+        if executor is not None:
 
-    if _EMBED_MODEL is not None:
+            executor.shutdown(wait=True)
 
-        return
 
-    if ST_AVAILABLE:
+
+    def stats(self) -> t.Dict[str, t.Any]:
+
+        with self._lock:
+
+            return {"replicas": self.replicas, "threads": self.threads, "shard_min": self.shard_min,
+
+                    "batches": self.batches, "shards": self.shards, "texts": self.texts}
+
+
+
+class ModelRegistry:
+
+    def __init__(self, names: t.List[str]):
+
+        self.names = list(dict.fromkeys(names))
+
+        self.default = self.names[0]
+
+        self._models: t.Dict[str, t.Any] = {}
+
+        self._batchers: t.Dict[str, MicroBatcher] = {}
+
+        self._pools: t.Dict[str, EncoderPool] = {}
+
+        self._info: t.Dict[str, t.Dict[str, t.Any]] = {}
+
+        self._lock = threading.Lock()
+
+
+
+    def get(self, name: t.Optional[str] = None):
+
+        name = name or self.default
+
+        if name not in self.names:
+
+            raise KeyError(name)
+
+        if name not in self._models:
+
+            with self._lock:
+
+                if name not in self._models:
+
+                    self._models[name] = self._load(name)
+
+        return self._models[name]
+
+
+
+    def _load(self, name: str):
+
+        self._info[name] = {"backend": "char_fallback", "dim": DEFAULT_DIM, "max_seq_length": DEFAULT_DIM}
+
+        if not ST_AVAILABLE:
+
+            return None
 
         try:
 
-            _EMBED_MODEL = SentenceTransformer(EMBED_MODEL_NAME)
+            started = time.perf_counter()
+
+            model = SentenceTransformer(name)
 
-            return
+            loaded = time.perf_counter()
+
+            model.encode(["warmup"], convert_to_numpy=True)
 
         except Exception:
 
-            _EMBED_MODEL = None
+            return None
+
+        self._info[name] = {"backend": "sentence_transformers", "dim": int(model.get_sentence_embedding_dimension() or DEFAULT_DIM),
+
+                            "max_seq_length": getattr(model, "max_seq_length", None),
+
+                            "load_ms": round((loaded - started) * 1000.0, 1), "warmup_ms": round((time.perf_counter() - loaded) * 1000.0, 1)}
+
+        return model
+
+
+
+    def batcher(self, name: t.Optional[str] = None) -> MicroBatcher:
+
+        name = name or self.default
+
+        if name not in self._batchers:
+
+            model = self.get(name)
+
+            with self._lock:
+
+                if name not in self._batchers:
+
+                    self._batchers[name] = MicroBatcher(lambda texts: self._encode(name, model, texts))
+
+        return self._batchers[name]
+
+
+
+    def _encode(self, name: str, model, texts: t.List[str]):
+
+        pool = self._pools.get(name)
+
+        if pool is None or not pool.wants(len(texts)):
+
+            return _encode(model, texts)
+
+        try:
+
+            return pool.encode(texts)
+
+        except BrokenProcessPool:
+
+            self.scale(name, 0)
+
+            return _encode(model, texts)
+
+
+
+    def scale(self, name: t.Optional[str], replicas: int, threads: t.Optional[int] = None) -> t.Optional[t.Dict[str, t.Any]]:
+
+        name = name or self.default
+
+        if self.get(name) is None:
+
+            raise ValueError(f"model not loaded: {name}")
+
+        with self._lock:
+
+            pool = self._pools.pop(name, None) if replicas <= 0 else self._pools.get(name)
+
+        if replicas <= 0:
+
+            if pool is not None:
+
+                pool.close()
+
+            return None
+
+        if pool is None:
+
+            pool = EncoderPool(name, replicas, threads)
+
+            with self._lock:
+
+                self._pools[name] = pool
+
+        else:
+
+            pool.resize(replicas, threads)
+
+        return pool.stats()
+
+
+
+    def warmup(self):
+
+        for name in self.names:
+
+            self.get(name)
+
+
+
+    def start_pools(self, replicas: int):
+
+        for name in self.names:
+
+            if name not in self._pools and self.get(name) is not None:
+
+                self.scale(name, replicas)
+
+
+
+    def close(self):
+
+        for name in list(self._pools):
+
+            self.scale(name, 0)
+
+
+
+    def describe(self) -> t.List[t.Dict[str, t.Any]]:
+
+        return [{"name": name, "default": name == self.default, "loaded": name in self._info, **self._info.get(name, {})} for name in self.names]
+
+
+
+    def batching_stats(self) -> t.Dict[str, t.Dict[str, t.Any]]:
+
+        return {name: b.stats() for name, b in list(self._batchers.items())}
 
-                                                                      
 
-    _EMBED_MODEL = None
 
+    def pool_stats(self) -> t.Dict[str, t.Dict[str, t.Any]]:
 
+        return {name: p.stats() for name, p in list(self._pools.items())}
 
-def _embed_with_model(texts: t.List[str]) -> t.List[t.List[float]]:
 
-    """
-    Returns list of float lists (numpy arrays converted) normalized.
-    """
 
-    _ensure_model()
+REGISTRY = ModelRegistry(EMBED_MODELS)
 
-    if _EMBED_MODEL is not None:
 
-        arr = _EMBED_MODEL.encode(texts, convert_to_numpy=True)
 
-                        
+def _embed_vectors(texts: t.List[str], model_name: t.Optional[str] = None):
 
-        norms = (arr**2).sum(axis=1, keepdims=True)**0.5 + 1e-12
+    """Normalized float32 matrix from the model, or float lists from the character fallback."""
 
-        arr = (arr / norms).astype("float32")
+    name = model_name or REGISTRY.default
 
-        return arr.tolist()
+    if REGISTRY.get(name) is not None:
+
+        cache = _cache()
+
+        if cache is None:
+
+            return REGISTRY.batcher(name).submit(texts)
+
+        cached = cache.get_many(name, texts)
+
+        misses = list(dict.fromkeys(txt for txt, v in zip(texts, cached) if v is None))
+
+        fresh = {}
+
+        if misses:
+
+            arr = REGISTRY.batcher(name).submit(misses)
+
+            cache.put_many(name, misses, arr)
+
+            fresh = dict(zip(misses, arr))
+
+        return np.vstack([v if v is not None else fresh[txt] for txt, v in zip(texts, cached)])
 
                                                             
 
@@ -124,31 +672,197 @@ def _embed_with_model(texts: t.List[str]) -> t.List[t.List[float]]:
 
 
 
+def _binary_response(vecs, accept: str, warning: t.Optional[str] = None) -> t.Optional[Response]:
+
+    media_type = next((m for m in BINARY_MEDIA_TYPES if m in accept), None)
+
+    if media_type is None or np is None:
+
+        return None
+
+    arr = np.ascontiguousarray(vecs, dtype="<f4")
+
+    headers = {"X-Embedding-Shape": f"{arr.shape[0]},{arr.shape[1]}", "X-Embedding-Dtype": "<f4"}
+
+    if warning:
+
+        headers["X-Embedding-Warning"] = warning[:200]
+
+    if media_type == "application/x-npy":
+
+        buf = io.BytesIO()
+
+        np.save(buf, arr, allow_pickle=False)
+
+        return Response(content=buf.getvalue(), media_type=media_type, headers=headers)
+
+    return Response(content=arr.tobytes(), media_type=media_type, headers=headers)
+
+
+
 @app.get("/")
 
 def root():
 
-    return {"ok": True, "service": "embed_service", "st_available": ST_AVAILABLE}
+    cache = _CACHE.stats() if _CACHE is not None else None
+
+    return {"ok": True, "service": "embed_service", "st_available": ST_AVAILABLE, "models": REGISTRY.names, "cache": cache,
+
+            "batching": REGISTRY.batching_stats(), "workers": REGISTRY.pool_stats()}
+
+
+
+@app.get("/models")
+
+def models():
+
+    return {"default": REGISTRY.default, "models": REGISTRY.describe()}
+
+
+
+@app.post("/workers")
+
+def workers(req: WorkersReq):
+
+    if req.model is not None and req.model not in REGISTRY.names:
+
+        raise HTTPException(status_code=404, detail=f"unknown model: {req.model}")
+
+    try:
+
+        return {"model": req.model or REGISTRY.default, "workers": REGISTRY.scale(req.model, req.replicas, req.threads)}
+
+    except ValueError as e:
+
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+
+@app.on_event("startup")
+
+def _warmup():
+
+    if EMBED_WARMUP:
+
+        REGISTRY.warmup()
+
+    if EMBED_WORKERS > 0:
+
+        REGISTRY.start_pools(EMBED_WORKERS)
+
+
+
+@app.on_event("shutdown")
+
+def _shutdown():
+
+    REGISTRY.close()
 
 
 
 @app.post("/embed")
 
-def embed(req: EmbedReq):
+def embed(req: EmbedReq, request: Request, model: t.Optional[str] = None):
+
+    if model is not None and model not in REGISTRY.names:
+
+        raise HTTPException(status_code=404, detail=f"unknown model: {model}")
 
     if not req.texts:
 
         return {"embeddings": []}
 
-    try:
+    accept = request.headers.get("accept", "")
+
+    warning = None
 
-        embs = _embed_with_model(req.texts)
+    try:
 
-        return {"embeddings": embs}
+        vecs = _embed_vectors(req.texts, model)
 
     except Exception as e:
 
                                                               
 
-        return {"embeddings": _embed_with_model(req.texts), "warning": str(e)}
+        vecs, warning = _embed_vectors(req.texts, model), str(e)
+
+    binary = _binary_response(vecs, accept, warning)
+
+    if binary is not None:
+
+        return binary
+
+    embs = vecs.tolist() if np is not None and isinstance(vecs, np.ndarray) else vecs
+
+    return {"embeddings": embs, "warning": warning} if warning else {"embeddings": embs}
+
+
+
+if __name__ == "__main__":
+
+    import argparse, pprint
+
+    p = argparse.ArgumentParser(prog="embed_service")
+
+    sub = p.add_subparsers(dest="cmd")
+
+    b = sub.add_parser("bench", help="texts/s of one large encode for each worker-pool replica count (0 = in-process)")
+
+    b.add_argument("--model", default=EMBED_MODEL_NAME)
+
+    b.add_argument("--n", type=int, default=4096)
+
+    b.add_argument("--replicas", default="0,1,2,4,8")
+
+    b.add_argument("--threads", type=int, default=0)
+
+    b.add_argument("--repeat", type=int, default=3)
+
+    args = p.parse_args()
+
+    if args.cmd == "bench":
+
+        if not ST_AVAILABLE:
+
+            raise SystemExit("sentence_transformers is not installed")
+
+        registry = ModelRegistry([args.model])
+
+        model = registry.get(args.model)
+
+        texts = [f"benchmark sentence {i} about memories, feelings and the weather on day {i % 365}" for i in range(args.n)]
+
+        report = []
+
+        for replicas in [int(r) for r in args.replicas.split(",")]:
+
+            t0 = time.perf_counter()
+
+            registry.scale(args.model, replicas, args.threads or None)
+
+            t_scale = time.perf_counter() - t0
+
+            best = float("inf")
+
+            for _ in range(args.repeat):
+
+                t0 = time.perf_counter()
+
+                out = registry._encode(args.model, model, texts)
+
+                best = min(best, time.perf_counter() - t0)
+
+            pool = registry.pool_stats().get(args.model) or {}
+
+            report.append({"replicas": replicas, "threads": pool.get("threads", 0), "texts_per_s": round(args.n / best, 1),
+
+                           "scale_s": round(t_scale, 2), "shape": tuple(out.shape)})
+
+        registry.close()
+
+        pprint.pprint({"model": args.model, "n": args.n, "cpus": os.cpu_count(), "results": report})
+
+    else:
+
+        p.print_help()
 
@@ -6,460 +6,3809 @@ from __future__ import annotations
 
 import os
 
+import io
+
+import re
+
 import sqlite3
 
-import json
+import json
+
+import base64
+
+import uuid
+
+import threading
+
+import time
+
+import random
+
+import shutil              
+
+import struct
+
+import atexit
+
+import zlib
+
+import hashlib
+
+from collections import OrderedDict
+
+from contextlib import contextmanager
+
+from dataclasses import dataclass, replace
+
+from typing import List, Dict, Any, Optional, Callable, Tuple, Iterator
+
+from pathlib import Path
+
+from datetime import datetime, timezone
+
+
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+import numpy as np
+
+from .utils.logging import log_action
+
+from .embed_cache import EmbedCache, EMBED_CACHE_PATH, EMBED_CACHE_ENABLED, text_key                                      
+
+
+
+                  
+
+try:
+
+    import faiss
+
+    FAISS_AVAILABLE = True
+
+except Exception:
+
+    faiss = None
+
+    FAISS_AVAILABLE = False
+
+
+
+try:
+
+    from sentence_transformers import SentenceTransformer
+
+    ST_AVAILABLE = True
+
+except Exception:
+
+    SentenceTransformer = None
+
+    ST_AVAILABLE = False
+
+
+
+try:
+
+    sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE fts5_probe USING fts5(x)")
+
+    FTS_AVAILABLE = True
+
+except Exception:
+
+    FTS_AVAILABLE = False
+
+
+
+           
+
+ROOT = Path(__file__).resolve().parents[1]
+
+DB_DIR = ROOT / "db"
+
+DB_DIR.mkdir(parents=True, exist_ok=True)
+
+SQLITE_PATH = DB_DIR / "memories.sqlite"
+
+FAISS_INDEX_PATH = DB_DIR / "faiss.index"
+
+DEFAULT_EMBED_URL = os.environ.get("MAINMI_EMBED_URL", "http://127.0.0.1:9000/embed")
+
+DEFAULT_EMBED_MODEL_NAME = os.environ.get("MAINMI_EMBED_MODEL", "all-MiniLM-L6-v2")
+
+DEFAULT_DIM = 384
+
+SQLITE_BUSY_TIMEOUT_MS = 250
+
+SQLITE_WRITE_RETRIES = 40
+
+SQLITE_CACHE_KB = 65536
+
+SQLITE_MMAP_BYTES = 256 * 1024 * 1024
+
+SQLITE_STATEMENT_CACHE = 256
+
+SQLITE_MAX_VARS = 900
+
+INGEST_BATCH_SIZE = int(os.environ.get("MAINMI_INGEST_BATCH", "256"))
+
+INDEX_CHECKPOINT_SECS = float(os.environ.get("MAINMI_INDEX_CHECKPOINT_SECS", "60"))
+
+INDEX_JOURNAL_MAX_BYTES = int(float(os.environ.get("MAINMI_INDEX_JOURNAL_MAX_MB", "16")) * 1024 * 1024)
+
+INDEX_MODE = os.environ.get("MAINMI_INDEX_MODE", "auto")
+
+INDEX_IVF_MIN_ROWS = int(os.environ.get("MAINMI_INDEX_IVF_MIN_ROWS", "50000"))
+
+INDEX_HNSW_MIN_ROWS = int(os.environ.get("MAINMI_INDEX_HNSW_MIN_ROWS", "1000000"))
+
+INDEX_NPROBE = int(os.environ.get("MAINMI_INDEX_NPROBE", "16"))
+
+INDEX_EF_SEARCH = int(os.environ.get("MAINMI_INDEX_EF_SEARCH", "64"))
+
+INDEX_HNSW_M = int(os.environ.get("MAINMI_INDEX_HNSW_M", "32"))
+
+INDEX_EF_CONSTRUCTION = int(os.environ.get("MAINMI_INDEX_EF_CONSTRUCTION", "80"))
+
+INDEX_TRAIN_SAMPLE = int(os.environ.get("MAINMI_INDEX_TRAIN_SAMPLE", "100000"))
+
+INDEX_REBUILD_GROWTH = float(os.environ.get("MAINMI_INDEX_REBUILD_GROWTH", "2.0"))
+
+INDEX_MAX_DEAD_RATIO = float(os.environ.get("MAINMI_INDEX_MAX_DEAD_RATIO", "0.2"))
+
+INDEX_QUANTIZER = os.environ.get("MAINMI_INDEX_QUANTIZER", "none")
+
+INDEX_PQ_MIN_ROWS = int(os.environ.get("MAINMI_INDEX_PQ_MIN_ROWS", "10000"))
+
+INDEX_PQ_M = int(os.environ.get("MAINMI_INDEX_PQ_M", "0"))
+
+INDEX_RERANK = int(os.environ.get("MAINMI_INDEX_RERANK", "4"))
+
+INDEX_KINDS = ("flat", "ivf", "hnsw")
+
+INDEX_QUANTIZERS = ("none", "sq8", "pq")
+
+INDEX_PATCH_MAX_RATIO = float(os.environ.get("MAINMI_INDEX_PATCH_MAX_RATIO", "0.25"))
+
+INDEX_MANIFEST_VERSION = 1
+
+VECTOR_SCAN_BATCH = 4096
+
+VECTOR_SCAN_CELLS = 1 << 24
+
+META_CACHE_ROWS = int(os.environ.get("MAINMI_META_CACHE_ROWS", "4096"))
+
+ROW_COLUMNS = "rid, id, text, tags, created_at, embedding_model, importance, hit_count"
+
+SEARCH_MODE = os.environ.get("MAINMI_SEARCH_MODE", "hybrid")
+
+SEARCH_MODES = ("hybrid", "vector", "lexical")
+
+SEARCH_CANDIDATES = int(os.environ.get("MAINMI_SEARCH_CANDIDATES", "50"))
+
+RRF_K = int(os.environ.get("MAINMI_RRF_K", "60"))
+
+LEXICAL_SHORTCIRCUIT_TERMS = int(os.environ.get("MAINMI_LEXICAL_SHORTCIRCUIT_TERMS", "3"))
+
+FTS_MAX_TERMS = 32
+
+FILTER_EXACT_ROWS = int(os.environ.get("MAINMI_FILTER_EXACT_ROWS", "8192"))
+
+RECENCY_HALF_LIFE_DAYS = float(os.environ.get("MAINMI_RECENCY_HALF_LIFE_DAYS", "0"))
+
+RECENCY_WEIGHT = float(os.environ.get("MAINMI_RECENCY_WEIGHT", "1.0"))
+
+IMPORTANCE_WEIGHT = float(os.environ.get("MAINMI_IMPORTANCE_WEIGHT", "1.0"))
+
+DEFAULT_IMPORTANCE = 0.5
+
+MMR_CANDIDATES = int(os.environ.get("MAINMI_MMR_CANDIDATES", "64"))
+
+DEDUP = os.environ.get("MAINMI_DEDUP", "0") == "1"
+
+DEDUP_THRESHOLD = float(os.environ.get("MAINMI_DEDUP_THRESHOLD", "0.95"))
+
+MIGRATION_BATCH = 1000
+
+EMBED_CACHE_SIZE = int(os.environ.get("MAINMI_EMBED_CACHE_SIZE", "2048"))
+
+EMBED_CONNECT_TIMEOUT = float(os.environ.get("MAINMI_EMBED_CONNECT_TIMEOUT", "0.5"))
+
+EMBED_READ_TIMEOUT = float(os.environ.get("MAINMI_EMBED_READ_TIMEOUT", "30"))
+
+EMBED_POOL_SIZE = int(os.environ.get("MAINMI_EMBED_POOL_SIZE", "8"))
+
+EMBED_BREAKER_FAILURES = int(os.environ.get("MAINMI_EMBED_BREAKER_FAILURES", "2"))
+
+EMBED_BREAKER_COOLDOWN = float(os.environ.get("MAINMI_EMBED_BREAKER_COOLDOWN", "30"))
+
+EMBED_WIRE_FORMAT = os.environ.get("MAINMI_EMBED_WIRE_FORMAT", "float32")
+
+EMBED_ACCEPT = {"float32": "application/x-float32, application/json;q=0.5",
+
+                "npy": "application/x-npy, application/json;q=0.5", "json": "application/json"}
+
+
+
+          
+
+def _float32_to_b64(x: np.ndarray) -> str:
+
+    return base64.b64encode(x.astype(np.float32).tobytes()).decode("ascii")
+
+
+
+def _b64_to_float32(s: str) -> np.ndarray:
+
+    b = base64.b64decode(s.encode("ascii"))
+
+    return np.frombuffer(b, dtype=np.float32).copy()
+
+
+
+def _float32_to_blob(x: np.ndarray) -> bytes:
+
+    return np.ascontiguousarray(x, dtype="<f4").tobytes()
+
+
+
+def _blob_to_float32(b: bytes) -> np.ndarray:
+
+    return np.frombuffer(b, dtype="<f4")
+
+
+
+def _decode_embeddings(r: requests.Response) -> Optional[np.ndarray]:
+
+    ctype = r.headers.get("Content-Type", "").split(";")[0].strip()
+
+    if ctype == "application/x-float32":
+
+        n, d = (int(x) for x in r.headers["X-Embedding-Shape"].split(","))
+
+        return _blob_to_float32(r.content).reshape(n, d)
+
+    if ctype == "application/x-npy":
+
+        return np.load(io.BytesIO(r.content), allow_pickle=False)
+
+    j = r.json()
+
+    arrs = j.get("embeddings") or j.get("embedding") or None
+
+    return None if arrs is None else np.asarray(arrs, dtype=np.float32)
+
+
+
+def _blobs_to_matrix(blobs: List[bytes]) -> np.ndarray:
+
+    if not blobs:
+
+        return np.zeros((0, 0), dtype=np.float32)
+
+    return np.frombuffer(b"".join(blobs), dtype="<f4").reshape(len(blobs), -1)
+
+
+
+def _normalize(vecs: np.ndarray) -> np.ndarray:
+
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-12
+
+    return (vecs / norms).astype("float32")
+
+
+
+@dataclass
+
+class IndexConfig:
+
+    mode: str = INDEX_MODE
+
+    ivf_min_rows: int = INDEX_IVF_MIN_ROWS
+
+    hnsw_min_rows: int = INDEX_HNSW_MIN_ROWS
+
+    nprobe: int = INDEX_NPROBE
+
+    ef_search: int = INDEX_EF_SEARCH
+
+    hnsw_m: int = INDEX_HNSW_M
+
+    ef_construction: int = INDEX_EF_CONSTRUCTION
+
+    train_sample: int = INDEX_TRAIN_SAMPLE
+
+    rebuild_growth: float = INDEX_REBUILD_GROWTH
+
+    max_dead_ratio: float = INDEX_MAX_DEAD_RATIO
+
+    quantizer: str = INDEX_QUANTIZER
+
+    pq_min_rows: int = INDEX_PQ_MIN_ROWS
+
+    pq_m: int = INDEX_PQ_M
+
+    rerank: int = INDEX_RERANK
+
+
+
+    def kind_for(self, n: int) -> str:
+
+        if self.mode in INDEX_KINDS:
+
+            return self.mode
+
+        if n >= self.hnsw_min_rows:
+
+            return "hnsw"
+
+        if n >= self.ivf_min_rows:
+
+            return "ivf"
+
+        return "flat"
+
+
+
+    def nlist_for(self, n: int) -> int:
+
+        return max(1, min(int(4 * np.sqrt(max(n, 1))), n // 39))
+
+
+
+    def quantizer_for(self, n: int) -> str:
+
+        if self.quantizer == "pq" and n < max(self.pq_min_rows, 256):
+
+            return "sq8"
+
+        return self.quantizer if self.quantizer in INDEX_QUANTIZERS else "none"
+
+
+
+    def pq_m_for(self, dim: int) -> int:
+
+        m = max(1, min(self.pq_m or dim // 4, dim))
+
+        while dim % m:
+
+            m -= 1
+
+        return m
+
+
+
+def _index_kind(index) -> str:
+
+    if isinstance(index, faiss.IndexIVF):
+
+        return "ivf"
+
+    if isinstance(index, faiss.IndexIDMap) and isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW):
+
+        return "hnsw"
+
+    return "flat"
+
+
+
+def _rid_digest(rids: np.ndarray) -> str:
+
+    return f"{zlib.crc32(np.ascontiguousarray(rids, dtype='<i8').tobytes()):08x}"
+
+
+
+def _code_index(index):
+
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+    if isinstance(base, faiss.IndexHNSW):
+
+        base = faiss.downcast_index(base.storage)
+
+    return base
+
+
+
+def _index_quantizer(index) -> str:
+
+    base = _code_index(index)
+
+    if isinstance(base, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+
+        return "pq"
+
+    if isinstance(base, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+
+        return "sq8"
+
+    return "none"
+
+
+
+def _faiss_ids(index) -> np.ndarray:
+
+    if isinstance(index, faiss.IndexIVF):
+
+        inv = index.invlists
+
+        parts = [faiss.rev_swig_ptr(inv.get_ids(l), inv.list_size(l)).copy() for l in range(index.nlist) if inv.list_size(l)]
+
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    return faiss.vector_to_array(index.id_map)
+
+
+
+def _tune_faiss_index(index, cfg: IndexConfig):
+
+    kind = _index_kind(index)
+
+    if kind == "ivf":
+
+        index.nprobe = max(1, min(cfg.nprobe, index.nlist))
+
+    elif kind == "hnsw":
+
+        faiss.downcast_index(index.index).hnsw.efSearch = cfg.ef_search
+
+
+
+def _new_faiss_index(kind: str, quant: str, dim: int, n: int, sample: np.ndarray, cfg: IndexConfig):
+
+    ip = faiss.METRIC_INNER_PRODUCT
+
+    sq8 = faiss.ScalarQuantizer.QT_8bit
+
+    if kind == "ivf" and n > 0:
+
+        coarse, nlist = faiss.IndexFlatIP(dim), cfg.nlist_for(n)
+
+        if quant == "sq8":
+
+            index = faiss.IndexIVFScalarQuantizer(coarse, dim, nlist, sq8, ip)
+
+        elif quant == "pq":
+
+            index = faiss.IndexIVFPQ(coarse, dim, nlist, cfg.pq_m_for(dim), 8, ip)
+
+        else:
+
+            index = faiss.IndexIVFFlat(coarse, dim, nlist, ip)
+
+    elif kind == "hnsw":
+
+        if quant == "sq8":
+
+            inner = faiss.IndexHNSWSQ(dim, sq8, cfg.hnsw_m, ip)
+
+        elif quant == "pq":
+
+            inner = faiss.IndexHNSWPQ(dim, cfg.pq_m_for(dim), cfg.hnsw_m, 8, ip)
+
+        else:
+
+            inner = faiss.IndexHNSWFlat(dim, cfg.hnsw_m, ip)
+
+        inner.hnsw.efConstruction = cfg.ef_construction
+
+        index = faiss.IndexIDMap2(inner)
+
+    elif quant == "sq8":
+
+        index = faiss.IndexIDMap2(faiss.IndexScalarQuantizer(dim, sq8, ip))
+
+    elif quant == "pq":
+
+        index = faiss.IndexIDMap2(faiss.IndexPQ(dim, cfg.pq_m_for(dim), 8, ip))
+
+    else:
+
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+    if not index.is_trained and len(sample):
+
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+
+    _tune_faiss_index(index, cfg)
+
+    return index
+
+
+
+def _build_faiss_index(kind: str, vecs: np.ndarray, rids: np.ndarray, cfg: IndexConfig):
+
+    n, dim = vecs.shape
+
+    sample = vecs
+
+    if n > cfg.train_sample:
+
+        sample = vecs[np.sort(np.random.default_rng(0).choice(n, cfg.train_sample, replace=False))]
+
+    index = _new_faiss_index(kind, cfg.quantizer_for(n), dim, n, sample, cfg)
+
+    if n:
+
+        index.add_with_ids(np.ascontiguousarray(vecs, dtype=np.float32), np.asarray(rids, dtype=np.int64))
+
+    return index
+
+
+
+               
+
+@dataclass
+
+class MemoryEntry:
+
+    id: str
+
+    text: str
+
+    tags: List[str]
+
+    created_at: str
+
+    embedding_model: str
+
+    embedding: Optional[np.ndarray] = None
+
+    rid: int = 0
+
+    importance: float = DEFAULT_IMPORTANCE
+
+    hit_count: int = 1
+
+
+
+    def to_dict(self, include_embedding: bool = False) -> Dict[str, Any]:
+
+        d = {"id": self.id, "text": self.text, "tags": list(self.tags), "created_at": self.created_at,
+
+             "embedding_model": self.embedding_model, "importance": self.importance, "hit_count": self.hit_count}
+
+        if include_embedding and self.embedding is not None:
+
+            d["embedding_b64"] = _float32_to_b64(self.embedding)
+
+        return d
+
+
+
+             
+
+class EmbeddingCache:
+
+    def __init__(self, capacity: int = EMBED_CACHE_SIZE):
+
+        self.capacity = capacity
+
+        self._vecs: "OrderedDict[Tuple[str, bytes], np.ndarray]" = OrderedDict()
+
+        self._lock = threading.Lock()
+
+        self.hits = 0
+
+        self.misses = 0
+
+
+
+    @staticmethod
+
+    def _key(model: str, text: str) -> Tuple[str, bytes]:
+
+        return model, hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest()
+
+
+
+    def lookup(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+
+        out: List[Optional[np.ndarray]] = []
+
+        with self._lock:
+
+            for t in texts:
+
+                key = self._key(model, t)
+
+                vec = self._vecs.get(key)
+
+                if vec is not None:
+
+                    self._vecs.move_to_end(key)
+
+                    self.hits += 1
+
+                else:
+
+                    self.misses += 1
+
+                out.append(vec)
+
+        return out
+
+
+
+    def store(self, model: str, texts: List[str], vecs: np.ndarray):
+
+        if self.capacity <= 0:
+
+            return
+
+        with self._lock:
+
+            for t, v in zip(texts, vecs):
+
+                key = self._key(model, t)
+
+                self._vecs[key] = np.array(v, dtype=np.float32)
+
+                self._vecs.move_to_end(key)
+
+            while len(self._vecs) > self.capacity:
+
+                self._vecs.popitem(last=False)
+
+
+
+    def clear(self):
+
+        with self._lock:
+
+            self._vecs.clear()
+
+
+
+    def stats(self) -> Dict[str, Any]:
+
+        with self._lock:
+
+            total = self.hits + self.misses
+
+            return {"size": len(self._vecs), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+
+                    "hit_rate": self.hits / total if total else 0.0}
+
+
+
+    def __len__(self) -> int:
+
+        return len(self._vecs)
+
+
+
+class CircuitBreaker:
+
+    def __init__(self, probe: Callable[[], bool], failures: int = EMBED_BREAKER_FAILURES, cooldown: float = EMBED_BREAKER_COOLDOWN,
+
+                 name: str = "embed_service"):
+
+        self.probe = probe
+
+        self.failures = max(1, int(failures))
+
+        self.cooldown = float(cooldown)
+
+        self.name = name
+
+        self._lock = threading.Lock()
+
+        self._errors = 0
+
+        self._opened_at: Optional[float] = None
+
+        self._probing = False
+
+        self.trips = 0
+
+
+
+    @property
+
+    def closed(self) -> bool:
+
+        return self._opened_at is None
+
+
+
+    def allow(self) -> bool:
+
+        with self._lock:
+
+            if self._opened_at is None:
+
+                return True
+
+            if not self._probing and time.monotonic() - self._opened_at >= self.cooldown:
+
+                self._probing = True
+
+                threading.Thread(target=self._run_probe, daemon=True, name=f"mainmi-{self.name}-probe").start()
+
+            return False
+
+
+
+    def _run_probe(self):
+
+        try:
+
+            ok = bool(self.probe())
+
+        except Exception:
+
+            ok = False
+
+        with self._lock:
+
+            self._probing = False
+
+            if ok:
+
+                self._errors = 0
+
+                self._opened_at = None
+
+            else:
+
+                self._opened_at = time.monotonic()
+
+        log_action("breaker_probe", {"name": self.name, "ok": ok})
+
+
+
+    def record_success(self):
+
+        with self._lock:
+
+            self._errors = 0
+
+
+
+    def record_failure(self):
+
+        with self._lock:
+
+            self._errors += 1
+
+            if self._opened_at is not None or self._errors < self.failures:
+
+                return
+
+            self._opened_at = time.monotonic()
+
+            self.trips += 1
+
+        log_action("breaker_open", {"name": self.name, "cooldown": self.cooldown})
+
+
+
+    def stats(self) -> Dict[str, Any]:
+
+        with self._lock:
+
+            opened = self._opened_at
+
+            return {"state": "closed" if opened is None else "open", "errors": self._errors, "trips": self.trips,
+
+                    "open_secs": 0.0 if opened is None else round(time.monotonic() - opened, 3), "probing": self._probing}
+
+
+
+class Embedder:
+
+    UNCACHED_BACKENDS = ("embed_service", "char_fallback")
+
+
+
+    def __init__(self, service_url: str = DEFAULT_EMBED_URL, local_model_name: str = DEFAULT_EMBED_MODEL_NAME,
+
+                 cache_size: int = EMBED_CACHE_SIZE, cache_path: Optional[Path] = EMBED_CACHE_PATH if EMBED_CACHE_ENABLED else None):
+
+        self.service_url = service_url
+
+        self.local_model_name = local_model_name
+
+        self._local_model = None
+
+        self._dim = DEFAULT_DIM
+
+        self.cache = EmbeddingCache(cache_size)
+
+        self.cache_path = cache_path
+
+        self._store: Optional[EmbedCache] = None
+
+        self._session: Optional[requests.Session] = None
+
+        self._session_lock = threading.Lock()
+
+        self.breaker = CircuitBreaker(self._probe_service)
+
+        self.service_model: Optional[str] = None
+
+        self.max_seq_length: Optional[int] = None
+
+        if not (self.service_url and self.discover()):
+
+            self._ensure_local()
+
+
+
+    def _ensure_local(self):
+
+        if self._local_model is None and ST_AVAILABLE:
+
+            try:
+
+                self._local_model = SentenceTransformer(self.local_model_name)
+
+            except Exception:
+
+                self._local_model = None
+
+            if self._local_model is not None and self.max_seq_length is None:
+
+                self._dim = int(self._local_model.get_sentence_embedding_dimension() or self._dim)
+
+                self.max_seq_length = getattr(self._local_model, "max_seq_length", None)
+
+
+
+    @property
+
+    def models_url(self) -> str:
+
+        return self.service_url.rsplit("/", 1)[0] + "/models"
+
+
+
+    def discover(self) -> Optional[Dict[str, Any]]:
+
+        if not self.service_url or not self.breaker.allow():
+
+            return None
+
+        try:
+
+            r = self._http().get(self.models_url, timeout=(EMBED_CONNECT_TIMEOUT, EMBED_READ_TIMEOUT))
+
+        except Exception:
+
+            self.breaker.record_failure()
+
+            return None
+
+        self.breaker.record_success()
+
+        try:
+
+            r.raise_for_status()
+
+            j = r.json()
+
+            models = {m["name"]: m for m in j.get("models", [])}
+
+        except Exception:
+
+            return None
+
+        info = models.get(self.local_model_name) or models.get(j.get("default"))
+
+        if info is None:
+
+            return None
+
+        self.service_model = info["name"] if info.get("backend") == "sentence_transformers" else None
+
+        self._dim = int(info.get("dim") or self._dim)
+
+        self.max_seq_length = info.get("max_seq_length")
+
+        log_action("embed_discover", {"model": self.service_model, "dim": self._dim, "max_seq_length": self.max_seq_length})
+
+        return info
+
+
+
+    @property
+
+    def model_used(self) -> str:
+
+        if self._local_model:
+
+            return self.local_model_name
+
+        if self.service_url:
+
+            return "embed_service"
+
+        return "char_fallback"
+
+
+
+    def embed_texts(self, texts: List[str], timeout: Optional[float] = None) -> np.ndarray:
+
+        if not texts:
+
+            return self._embed(texts, timeout)[0]
+
+        model = self._preferred_backend()
+
+        cached = self.cache.lookup(model, texts)
+
+        misses = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+
+        if not misses:
+
+            return np.vstack(cached)
+
+        fresh: Dict[str, np.ndarray] = {}
+
+        store = self._persistent(model)
+
+        if store is not None:
+
+            found = store.get_many(model, misses)
+
+            fresh = {t: v for t, v in zip(misses, found) if v is not None}
+
+            self.cache.store(model, list(fresh), list(fresh.values()))
+
+            misses = [t for t in misses if t not in fresh]
+
+        if misses:
+
+            vecs, used = self._embed(misses, timeout)
+
+            if used != model and (fresh or any(v is not None for v in cached)):
+
+                misses = list(dict.fromkeys(texts))
+
+                vecs, used = self._embed(misses, timeout, use_service=used == self._service_label())
+
+                cached, fresh = [None] * len(texts), {}
+
+            self.cache.store(used, misses, vecs)
+
+            store = self._persistent(used)
+
+            if store is not None:
+
+                store.put_many(used, misses, vecs)
+
+            fresh.update(zip(misses, vecs))
+
+        return np.vstack([v if v is not None else fresh[t] for t, v in zip(texts, cached)])
+
+
+
+    def _preferred_backend(self) -> str:
+
+        if self.service_url and self.breaker.closed:
+
+            return self._service_label()
+
+        self._ensure_local()
+
+        return self.local_model_name if self._local_model is not None else "char_fallback"
+
+
+
+    def _service_label(self) -> str:
+
+        return f"embed_service:{self.service_model}" if self.service_model else "embed_service"
+
+
+
+    def _persistent(self, model: str) -> Optional[EmbedCache]:
+
+        if model.split(":", 1)[0] in self.UNCACHED_BACKENDS or self.cache_path is None:
+
+            return None
+
+        if self._store is None:
+
+            try:
+
+                self._store = EmbedCache(self.cache_path)
+
+            except Exception:
+
+                self.cache_path = None
+
+                return None
+
+        return self._store
+
+
+
+    def _http(self) -> requests.Session:
+
+        if self._session is None:
+
+            with self._session_lock:
+
+                if self._session is None:
+
+                    session = requests.Session()
+
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=EMBED_POOL_SIZE)
+
+                    session.mount("http://", adapter)
+
+                    session.mount("https://", adapter)
+
+                    self._session = session
+
+        return self._session
+
+
+
+    def _probe_service(self) -> bool:
+
+        r = self._http().post(self.service_url, json={"texts": []}, timeout=(EMBED_CONNECT_TIMEOUT, EMBED_CONNECT_TIMEOUT * 4))
+
+        r.raise_for_status()
+
+        return True
+
+
+
+    def _embed(self, texts: List[str], timeout: Optional[float] = None, use_service: bool = True) -> Tuple[np.ndarray, str]:
+
+        if self.service_url and use_service and self.breaker.allow():
+
+            try:
+
+                params = {"model": self.service_model} if self.service_model else None
+
+                r = self._http().post(self.service_url, params=params, json={"texts": texts}, headers={"Accept": EMBED_ACCEPT.get(EMBED_WIRE_FORMAT, "application/json")},
+
+                                      timeout=(EMBED_CONNECT_TIMEOUT, timeout or EMBED_READ_TIMEOUT))
+
+                r.raise_for_status()
+
+                a = _decode_embeddings(r)
+
+                if a is not None:
+
+                    self.breaker.record_success()
+
+                    return _normalize(a), self._service_label()
+
+            except Exception:
+
+                pass
+
+            self.breaker.record_failure()
+
+        self._ensure_local()
+
+        if self._local_model is not None:
+
+            a = self._local_model.encode(texts, convert_to_numpy=True)
+
+            return _normalize(np.asarray(a, dtype=np.float32)), self.local_model_name
+
+        vecs = []
+
+        for t in texts:
+
+            v = np.zeros(self.dim, dtype=np.float32)
+
+            for i, ch in enumerate(t[:self.dim]):
+
+                v[i] = (ord(ch) % 100) / 100.0
+
+            vecs.append(v)
+
+        return _normalize(np.vstack(vecs)), "char_fallback"
+
+
+
+    def cache_stats(self) -> Dict[str, Any]:
+
+        stats = self.cache.stats()
+
+        if self._store is not None:
+
+            stats["persistent"] = self._store.stats()
+
+        return stats
+
+
+
+    def service_stats(self) -> Dict[str, Any]:
+
+        return {"url": self.service_url, **self.breaker.stats()} if self.service_url else {"url": ""}
+
+
+
+    def close(self):
+
+        if self._session is not None:
+
+            self._session.close()
+
+            self._session = None
+
+
+
+    @property
+
+    def dim(self) -> int:
+
+        return int(self._dim)
+
+
+
+class IndexJournal:
+
+    """8-byte header (magic, dim), then records of op byte + int64 rid (+ dim float32 for adds)."""
+
+
+
+    MAGIC = b"MJN1"
+
+    OP_ADD = 1
+
+    OP_REMOVE = 2
+
+
+
+    def __init__(self, path: Path, dim: int):
+
+        self.path = Path(path)
+
+        self.dim = int(dim)
+
+        self._header = self.MAGIC + struct.pack("<I", self.dim)
+
+        self._fh = None
+
+
+
+    def _open(self):
+
+        if self._fh is None:
+
+            fresh = not self.path.exists() or self.path.stat().st_size < len(self._header)
+
+            self._fh = open(self.path, "ab")
+
+            if fresh:
+
+                self._fh.truncate(0)
+
+                self._fh.write(self._header)
+
+                self._fh.flush()
+
+        return self._fh
+
+
+
+    def append(self, op: int, rids: np.ndarray, vecs: Optional[np.ndarray] = None):
+
+        rids = np.asarray(rids, dtype="<i8")
+
+        if op == self.OP_ADD:
+
+            vecs = np.ascontiguousarray(vecs, dtype="<f4").reshape(len(rids), self.dim)
+
+            parts = [struct.pack("<Bq", op, int(r)) + vecs[i].tobytes() for i, r in enumerate(rids)]
+
+        else:
+
+            parts = [struct.pack("<Bq", op, int(r)) for r in rids]
+
+        fh = self._open()
+
+        fh.write(b"".join(parts))
+
+        fh.flush()
+
+
+
+    def size(self) -> int:
+
+        if self._fh is not None:
+
+            return self._fh.tell()
+
+        return self.path.stat().st_size if self.path.exists() else 0
+
+
+
+    def pending(self) -> bool:
+
+        return self.size() > len(self._header)
+
+
+
+    def replay(self, apply: Callable[[int, np.ndarray, Optional[np.ndarray]], None]) -> int:
+
+        if not self.path.exists():
+
+            return 0
+
+        data = self.path.read_bytes()
+
+        if data[:len(self._header)] != self._header:
+
+            return -1
+
+        off, applied = len(self._header), 0
+
+        rec_add = 9 + 4 * self.dim
+
+        run_op, run_ids, run_vecs = None, [], []
+
+
+
+        def flush():
+
+            if run_ids:
+
+                vecs = np.vstack(run_vecs) if run_op == self.OP_ADD else None
+
+                apply(run_op, np.array(run_ids, dtype=np.int64), vecs)
+
+                run_ids.clear()
+
+                run_vecs.clear()
+
+
+
+        while off + 9 <= len(data):
+
+            op, rid = struct.unpack_from("<Bq", data, off)
+
+            if op not in (self.OP_ADD, self.OP_REMOVE) or (op == self.OP_ADD and off + rec_add > len(data)):
+
+                break
+
+            if op != run_op:
+
+                flush()
+
+                run_op = op
+
+            run_ids.append(rid)
+
+            if op == self.OP_ADD:
+
+                run_vecs.append(np.frombuffer(data, dtype="<f4", count=self.dim, offset=off + 9))
+
+                off += rec_add
+
+            else:
+
+                off += 9
+
+            applied += 1
+
+        flush()
+
+        return applied
+
+
+
+    def truncate_before(self, upto: int):
+
+        fh = self._open()
+
+        fh.flush()
+
+        end = fh.tell()
+
+        tail = b""
+
+        if end > upto:
+
+            with open(self.path, "rb") as f:
+
+                f.seek(upto)
+
+                tail = f.read(end - upto)
+
+        self.close()
+
+        tmp = self.path.with_name(self.path.name + ".tmp")
+
+        with open(tmp, "wb") as f:
+
+            f.write(self._header + tail)
+
+        os.replace(tmp, self.path)
+
+
+
+    def reset(self):
+
+        self.close()
+
+        with open(self.path, "wb") as f:
+
+            f.write(self._header)
+
+
+
+    def close(self):
+
+        if self._fh is not None:
+
+            try:
+
+                self._fh.close()
+
+            finally:
+
+                self._fh = None
+
+
+
+
+
+class RowCache:
+
+    def __init__(self, capacity: int = META_CACHE_ROWS):
+
+        self.capacity = capacity
+
+        self._rows: "OrderedDict[int, MemoryEntry]" = OrderedDict()
+
+        self.hits = 0
+
+        self.misses = 0
+
+
+
+    def get(self, rid: int) -> Optional[MemoryEntry]:
+
+        entry = self._rows.get(rid)
+
+        if entry is None:
+
+            self.misses += 1
+
+            return None
+
+        self._rows.move_to_end(rid)
+
+        self.hits += 1
+
+        return entry
+
+
+
+    def put(self, entry: MemoryEntry):
+
+        if self.capacity <= 0:
+
+            return
+
+        self._rows[entry.rid] = entry
+
+        self._rows.move_to_end(entry.rid)
+
+        while len(self._rows) > self.capacity:
+
+            self._rows.popitem(last=False)
+
+
+
+    def discard(self, rids):
+
+        for r in rids:
+
+            self._rows.pop(int(r), None)
+
+
+
+    def clear(self):
+
+        self._rows.clear()
+
+
+
+    def __len__(self) -> int:
+
+        return len(self._rows)
+
+
+
+def _to_epoch(value: Any) -> float:
+
+    if isinstance(value, (int, float)):
+
+        return float(value)
+
+    if isinstance(value, str):
+
+        try:
+
+            return float(value)
+
+        except ValueError:
+
+            value = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+
+    if isinstance(value, datetime):
+
+        if value.tzinfo is None:
+
+            value = value.replace(tzinfo=timezone.utc)
+
+        return value.timestamp()
+
+    raise ValueError(f"not a timestamp: {value!r}")
+
+
+
+def _created_ts(created_at: Optional[str]) -> Optional[float]:
+
+    try:
+
+        return _to_epoch(created_at) if created_at else None
+
+    except ValueError:
+
+        return None
+
+
+
+def _filter_sql(tags: Optional[List[str]] = None, since: Any = None, until: Any = None) -> Tuple[str, List[Any]]:
+
+    clauses: List[str] = []
+
+    params: List[Any] = []
+
+    if since is not None:
+
+        clauses.append("created_ts >= ?")
+
+        params.append(_to_epoch(since))
+
+    if until is not None:
+
+        clauses.append("created_ts < ?")
+
+        params.append(_to_epoch(until))
+
+    tags = list(dict.fromkeys(tags or []))
+
+    if tags:
+
+        clauses.append(f"rid IN (SELECT rid FROM memory_tags WHERE tag IN ({','.join('?' * len(tags))}) GROUP BY rid HAVING count(*) = ?)")
+
+        params.extend(tags)
+
+        params.append(len(tags))
+
+    return " AND ".join(clauses), params
+
+
+
+def _top_rows(scores: np.ndarray, rids: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+
+    kk = min(k, scores.shape[1])
+
+    top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+
+    part = np.take_along_axis(scores, top, axis=1)
+
+    order = np.argsort(-part, axis=1, kind="stable")
+
+    top, part = np.take_along_axis(top, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+    out = []
+
+    for row in range(len(scores)):
+
+        ok = np.isfinite(part[row])
+
+        out.append((rids[top[row][ok]], part[row][ok]))
+
+    return out
+
+
+
+def _mmr(relevance: np.ndarray, vecs: np.ndarray, k: int, lam: float) -> np.ndarray:
+
+    n = len(relevance)
+
+    k = min(k, n)
+
+    if k <= 0:
+
+        return np.zeros(0, dtype=np.int64)
+
+    sim = vecs @ vecs.T
+
+    picked = np.zeros(k, dtype=np.int64)
+
+    picked[0] = int(np.argmax(relevance))
+
+    taken = np.zeros(n, dtype=bool)
+
+    taken[picked[0]] = True
+
+    redundancy = sim[picked[0]].copy()
+
+    for i in range(1, k):
+
+        score = lam * relevance - (1.0 - lam) * redundancy
+
+        score[taken] = -np.inf
+
+        picked[i] = int(np.argmax(score))
+
+        taken[picked[i]] = True
+
+        np.maximum(redundancy, sim[picked[i]], out=redundancy)
+
+    return picked
+
+
+
+def _make_cursor(created_ts: Optional[float], rid: int) -> str:
+
+    return f"{'' if created_ts is None else repr(float(created_ts))}:{int(rid)}"
+
+
+
+def _parse_cursor(cursor: Optional[str]) -> Tuple[Optional[float], Optional[int]]:
+
+    if cursor is None:
+
+        return None, None
+
+    try:
+
+        ts, rid = cursor.rsplit(":", 1)
+
+        return (float(ts) if ts else None), int(rid)
+
+    except ValueError:
+
+        raise ValueError(f"invalid cursor: {cursor!r}")
+
+
+
+def _identifier_query(text: str) -> bool:
+
+    tokens = text.split()
+
+    return bool(tokens) and all(any(ch.isdigit() for ch in t) for t in tokens)
+
+
+
+def _fts_query(text: str, match_all: bool = False) -> Tuple[str, int]:
+
+    terms = list(dict.fromkeys(re.findall(r"\w+", text.lower())))[:FTS_MAX_TERMS]
+
+    return (" " if match_all else " OR ").join(f'"{t}"' for t in terms), len(terms)
+
+
+
+def _row_entry(row) -> MemoryEntry:
+
+    return MemoryEntry(id=row[1], text=row[2], tags=json.loads(row[3]) if row[3] else [], created_at=row[4], embedding_model=row[5], rid=row[0],
+
+                       importance=DEFAULT_IMPORTANCE if row[6] is None else row[6], hit_count=row[7] or 1)
+
+
+
+              
+
+class MemoryRAG:
+
+    def __init__(self, sqlite_path: Path = SQLITE_PATH, embedder: Optional[Embedder] = None, faiss_index_path: Optional[Path] = FAISS_INDEX_PATH,
+
+                 index_config: Optional[IndexConfig] = None):
+
+        self.sqlite_path = sqlite_path
+
+        self.index_config = index_config or IndexConfig()
+
+        self.embedder = embedder or Embedder()
+
+        self.faiss_index_path = faiss_index_path
+
+        self.lock = threading.RLock()
+
+        self._write_lock = threading.RLock()
+
+        self._local = threading.local()
+
+        self._conns: List[sqlite3.Connection] = []
+
+        self._conns_lock = threading.Lock()
+
+        self._init_db()
+
+        self._cache = RowCache()
+
+        self._index = None
+
+        self._dim = self.embedder.dim or DEFAULT_DIM
+
+        self._quantized = FAISS_AVAILABLE and self.index_config.quantizer_for(0) != "none"
+
+        self._vec_buf = np.zeros((0, 0 if self._quantized else self._dim), dtype=np.float32)
+
+        self._rid_buf = np.zeros(0, dtype=np.int64)
+
+        self._rows_shared = False
+
+        self._lo = 0
+
+        self._n = 0
+
+        self._journal: Optional[IndexJournal] = None
+
+        self._ckpt_lock = threading.Lock()
+
+        self._last_checkpoint = time.monotonic()
+
+        self._index_gen = 0
+
+        self._dead_labels: set = set()
+
+        self._rebuild_thread: Optional[threading.Thread] = None
+
+        self._rebuild_delta: Optional[list] = None
+
+        self._flush_wake = threading.Event()
+
+        self._flush_stop = threading.Event()
+
+        self._flusher: Optional[threading.Thread] = None
+
+        self._load_meta()
+
+        self._init_faiss()
+
+        if FAISS_AVAILABLE and self.faiss_index_path:
+
+            self._flusher = threading.Thread(target=self._flush_loop, name="memory-index-flusher", daemon=True)
+
+            self._flusher.start()
+
+            atexit.register(self.close)
+
+
+
+    def _conn(self) -> sqlite3.Connection:
+
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+
+            conn = sqlite3.connect(self.sqlite_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None,
+
+                                   cached_statements=SQLITE_STATEMENT_CACHE)
+
+            try:
+
+                conn.execute("PRAGMA journal_mode=WAL")
+
+            except sqlite3.OperationalError:
+
+                pass
+
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+            conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+
+            conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+
+            conn.execute("PRAGMA temp_store=MEMORY")
+
+            conn.create_function("py_lower", 1, lambda v: v.lower() if isinstance(v, str) else v, deterministic=True)
+
+            conn.create_function("py_text_key", 1, lambda v: text_key(v) if isinstance(v, str) else None, deterministic=True)
+
+            self._local.conn = conn
+
+            with self._conns_lock:
+
+                self._conns.append(conn)
+
+        return conn
+
+
+
+    @contextmanager
+
+    def _write(self) -> Iterator[sqlite3.Connection]:
+
+        with self._write_lock:
+
+            conn = self._conn()
+
+            for attempt in range(SQLITE_WRITE_RETRIES):
+
+                try:
+
+                    conn.execute("BEGIN IMMEDIATE")
+
+                    break
+
+                except sqlite3.OperationalError as e:
+
+                    msg = str(e).lower()
+
+                    if ("locked" not in msg and "busy" not in msg) or attempt == SQLITE_WRITE_RETRIES - 1:
+
+                        raise
+
+                    time.sleep(min(0.5, 0.005 * (2 ** attempt)) * (0.5 + random.random()))
+
+            try:
+
+                yield conn
+
+                conn.execute("COMMIT")
+
+            except BaseException:
+
+                if conn.in_transaction:
+
+                    conn.execute("ROLLBACK")
+
+                raise
+
+
+
+    def close(self):
+
+        with self.lock:
+
+            self._rebuild_delta = None
+
+        if self._flusher is not None:
+
+            self._flush_stop.set()
+
+            self._flush_wake.set()
+
+            self._flusher.join(timeout=5)
+
+            self._flusher = None
+
+            self._checkpoint()
+
+        if self._journal is not None:
+
+            self._journal.close()
+
+        with self._conns_lock:
+
+            conns, self._conns = self._conns, []
+
+        for conn in conns:
+
+            try:
+
+                conn.close()
+
+            except Exception:
+
+                pass
+
+        self._local = threading.local()
+
+
+
+    def _init_db(self):
+
+        conn = self._conn()
+
+        with self._write():
+
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS memories (
+                    rid INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    text TEXT NOT NULL,
+                    tags TEXT,
+                    created_at TEXT,
+                    embedding BLOB,
+                    embedding_model TEXT,
+                    created_ts REAL,
+                    importance REAL DEFAULT 0.5,
+                    text_hash BLOB,
+                    hit_count INTEGER DEFAULT 1,
+                    last_seen_ts REAL
+                );
+            """)
+
+        self._migrate_db(conn)
+
+        with self._write():
+
+            conn.execute("CREATE INDEX IF NOT EXISTS memories_text_hash ON memories(text_hash)")
+
+        self._init_tags(conn)
+
+        if FTS_AVAILABLE:
+
+            self._init_fts(conn)
+
+
+
+    def _init_tags(self, conn: sqlite3.Connection):
+
+        with self._write():
+
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'memory_tags'").fetchone()
+
+            conn.execute("CREATE INDEX IF NOT EXISTS memories_created_ts ON memories(created_ts)")
+
+            conn.execute("CREATE TABLE IF NOT EXISTS memory_tags (tag TEXT NOT NULL, rid INTEGER NOT NULL, PRIMARY KEY (tag, rid)) WITHOUT ROWID")
+
+            conn.execute("CREATE INDEX IF NOT EXISTS memory_tags_rid ON memory_tags(rid)")
+
+            tag_rows = "SELECT DISTINCT {rid}, j.value FROM json_each(CASE WHEN json_valid({tags}) THEN {tags} ELSE '[]' END) j WHERE j.type = 'text'"
+
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS memory_tags_ai AFTER INSERT ON memories BEGIN
+                    INSERT INTO memory_tags(rid, tag) {tag_rows.format(rid="new.rid", tags="new.tags")};
+                END
+            """)
+
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS memory_tags_ad AFTER DELETE ON memories BEGIN
+                    DELETE FROM memory_tags WHERE rid = old.rid;
+                END
+            """)
+
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS memory_tags_au AFTER UPDATE OF tags ON memories BEGIN
+                    DELETE FROM memory_tags WHERE rid = old.rid;
+                    INSERT INTO memory_tags(rid, tag) {tag_rows.format(rid="new.rid", tags="new.tags")};
+                END
+            """)
+
+            if not exists:
+
+                conn.execute(f"INSERT OR IGNORE INTO memory_tags(rid, tag) {tag_rows.format(rid='m.rid', tags='m.tags')}".replace(
+
+                    "FROM json_each", "FROM memories m, json_each"))
+
+
+
+    def _init_fts(self, conn: sqlite3.Connection):
+
+        with self._write():
+
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'memories_fts'").fetchone()
+
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(
+                    text, tags, content='memories', content_rowid='rid', tokenize='unicode61 remove_diacritics 2'
+                )
+            """)
+
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS memories_fts_ai AFTER INSERT ON memories BEGIN
+                    INSERT INTO memories_fts(rowid, text, tags) VALUES (new.rid, new.text, new.tags);
+                END
+            """)
+
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS memories_fts_ad AFTER DELETE ON memories BEGIN
+                    INSERT INTO memories_fts(memories_fts, rowid, text, tags) VALUES ('delete', old.rid, old.text, old.tags);
+                END
+            """)
+
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS memories_fts_au AFTER UPDATE OF text, tags ON memories BEGIN
+                    INSERT INTO memories_fts(memories_fts, rowid, text, tags) VALUES ('delete', old.rid, old.text, old.tags);
+                    INSERT INTO memories_fts(rowid, text, tags) VALUES (new.rid, new.text, new.tags);
+                END
+            """)
+
+            if not exists:
+
+                conn.execute("INSERT INTO memories_fts(memories_fts) VALUES ('rebuild')")
+
+        if not exists:
+
+            log_action("memory_fts_build", {})
+
+
+
+    @staticmethod
+
+    def _columns(conn: sqlite3.Connection) -> set:
+
+        return {r[1] for r in conn.execute("PRAGMA table_info(memories)")}
+
+
+
+    def _migrate_db(self, conn: sqlite3.Connection):
+
+        with self._write():
+
+            if "embedding" not in self._columns(conn):
+
+                conn.execute("ALTER TABLE memories ADD COLUMN embedding BLOB")
+
+        self._migrate_b64(conn)
+
+        self._migrate_rid(conn)
+
+        with self._write():
+
+            if "created_ts" not in self._columns(conn):
+
+                conn.execute("ALTER TABLE memories ADD COLUMN created_ts REAL")
+
+                conn.execute("UPDATE memories SET created_ts = round((julianday(created_at) - 2440587.5) * 86400.0, 3)")
+
+        with self._write():
+
+            if "importance" not in self._columns(conn):
+
+                conn.execute("ALTER TABLE memories ADD COLUMN importance REAL DEFAULT 0.5")
+
+        with self._write():
+
+            if "text_hash" not in self._columns(conn):
+
+                conn.execute("ALTER TABLE memories ADD COLUMN text_hash BLOB")
+
+                conn.execute("ALTER TABLE memories ADD COLUMN hit_count INTEGER DEFAULT 1")
+
+                conn.execute("ALTER TABLE memories ADD COLUMN last_seen_ts REAL")
+
+                conn.execute("UPDATE memories SET text_hash = py_text_key(text)")
+
+
+
+    def _migrate_b64(self, conn: sqlite3.Connection):
+
+        migrated = 0
+
+        while True:
+
+            with self._write():
+
+                if "embedding_b64" not in self._columns(conn):
+
+                    break
+
+                rows = conn.execute(
+
+                    "SELECT rowid, embedding_b64 FROM memories WHERE embedding IS NULL AND embedding_b64 IS NOT NULL LIMIT ?",
+
+                    (MIGRATION_BATCH,)
+
+                ).fetchall()
+
+                if not rows:
+
+                    break
+
+                conn.executemany("UPDATE memories SET embedding = ?, embedding_b64 = NULL WHERE rowid = ?",
+
+                                 [(_float32_to_blob(_b64_to_float32(b64)), rid) for rid, b64 in rows])
+
+            migrated += len(rows)
+
+        if migrated:
+
+            log_action("memory_migrate_blob", {"count": migrated})
+
+
+
+    def _migrate_rid(self, conn: sqlite3.Connection):
+
+        with self._write():
+
+            if "rid" in self._columns(conn):
+
+                return
+
+            conn.execute("""
+                CREATE TABLE memories_new (
+                    rid INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL UNIQUE,
+                    text TEXT NOT NULL,
+                    tags TEXT,
+                    created_at TEXT,
+                    embedding BLOB,
+                    embedding_model TEXT
+                );
+            """)
+
+            conn.execute("""
+                INSERT INTO memories_new (id, text, tags, created_at, embedding, embedding_model)
+                SELECT id, text, tags, created_at, embedding, embedding_model FROM memories ORDER BY created_at ASC, rowid ASC
+            """)
+
+            conn.execute("DROP TABLE memories")
+
+            conn.execute("ALTER TABLE memories_new RENAME TO memories")
+
+        if self.faiss_index_path and self.faiss_index_path.exists():
+
+            self.faiss_index_path.unlink()
+
+        log_action("memory_migrate_rid", {})
+
+
+
+    def _load_meta(self):
+
+        with self.lock:
+
+            column = "length(embedding)" if self._quantized else "embedding"
+
+            rows = self._conn().execute(f"SELECT rid, {column} FROM memories ORDER BY rid ASC").fetchall()
+
+            if self._quantized:
+
+                blob_len = next((r[1] for r in rows if r[1]), 0)
+
+                if blob_len:
+
+                    self._dim = blob_len // 4
+
+                mat = np.zeros((len(rows), 0), dtype=np.float32)
+
+            else:
+
+                blob_len = next((len(r[1]) for r in rows if r[1]), 0)
+
+                with_vec = [i for i, r in enumerate(rows) if r[1] and len(r[1]) == blob_len]
+
+                mat = _blobs_to_matrix([rows[i][1] for i in with_vec])
+
+                if with_vec:
+
+                    self._dim = int(mat.shape[1])
+
+                if len(with_vec) != len(rows) or not rows:
+
+                    full = np.zeros((len(rows), self._dim), dtype=np.float32)
+
+                    if with_vec:
+
+                        full[with_vec] = mat
+
+                    mat = full
+
+            if rows and self._dim != self.embedder.dim:
+
+                log_action("memory_dim_mismatch", {"stored": self._dim, "embedder": self.embedder.dim})
+
+            self._cache.clear()
+
+            self._set_rows(np.array([r[0] for r in rows], dtype=np.int64), mat)
+
+
+
+    def _entries(self, rids) -> Dict[int, MemoryEntry]:
+
+        out: Dict[int, MemoryEntry] = {}
+
+        missing = []
+
+        for r in rids:
+
+            entry = self._cache.get(int(r))
+
+            if entry is None:
+
+                missing.append(int(r))
+
+            else:
+
+                out[entry.rid] = entry
+
+        for i in range(0, len(missing), SQLITE_MAX_VARS):
+
+            chunk = missing[i:i + SQLITE_MAX_VARS]
+
+            for row in self._conn().execute(f"SELECT {ROW_COLUMNS} FROM memories WHERE rid IN ({','.join('?' * len(chunk))})", chunk):
+
+                entry = _row_entry(row)
+
+                self._cache.put(entry)
+
+                out[entry.rid] = entry
+
+        return out
+
+
+
+    def _latest_model(self, conn: Optional[sqlite3.Connection] = None) -> Optional[str]:
+
+        row = (conn or self._conn()).execute("SELECT embedding_model FROM memories ORDER BY rid DESC LIMIT 1").fetchone()
+
+        return row[0] if row else None
+
+
+
+    @property
+
+    def _vectors(self) -> np.ndarray:
+
+        return self._vec_buf[self._lo:self._lo + self._n]
+
+
+
+    @property
+
+    def _rids(self) -> np.ndarray:
+
+        return self._rid_buf[self._lo:self._lo + self._n]
+
+
+
+    def _set_rows(self, rids: np.ndarray, mat: np.ndarray):
+
+        self._rid_buf = np.array(rids, dtype=np.int64)
+
+        self._vec_buf = np.array(mat, dtype=np.float32, order="C")
+
+        self._rows_shared = False
+
+        self._lo = 0
+
+        self._n = len(mat)
+
+
+
+    def _move_rows(self, dst: int, src: int, length: int):
+
+        step = VECTOR_SCAN_BATCH
+
+        starts = range(0, length, step) if dst < src else range((length - 1) // step * step, -1, -step)
+
+        for off in starts:
+
+            end = min(length, off + step)
+
+            self._vec_buf[dst + off:dst + end] = self._vec_buf[src + off:src + end]
+
+            self._rid_buf[dst + off:dst + end] = self._rid_buf[src + off:src + end]
+
+
+
+    def _compact_rows(self, pos: np.ndarray):
+
+        if self._rows_shared:
+
+            self._vec_buf = self._vec_buf.copy()
+
+            self._rows_shared = False
+
+        cut = pos + self._lo
+
+        end = self._lo + self._n
+
+        if end - cut[0] <= cut[-1] + 1 - self._lo:
+
+            write = int(cut[0])
+
+            for start, stop in zip(cut + 1, np.append(cut[1:], end)):
+
+                self._move_rows(write, int(start), int(stop - start))
+
+                write += int(stop - start)
+
+        else:
+
+            write = int(cut[-1]) + 1
+
+            for start, stop in zip(np.append(self._lo, cut[:-1] + 1)[::-1], cut[::-1]):
+
+                write -= int(stop - start)
+
+                self._move_rows(write, int(start), int(stop - start))
+
+            self._lo = write
+
+        self._n -= len(pos)
+
+
+
+    def _resident(self, vecs: np.ndarray) -> np.ndarray:
+
+        return vecs[:, :0] if self._quantized else vecs
+
+
+
+    def _append_rows(self, rids: np.ndarray, rows: np.ndarray):
+
+        rows = np.asarray(rows, dtype=np.float32).reshape(len(rows), -1)
+
+        if self._n == 0:
+
+            self._dim = rows.shape[1]
+
+        rows = self._resident(rows)
+
+        if self._n == 0 and self._vec_buf.shape[1] != rows.shape[1]:
+
+            self._vec_buf = np.zeros((0, rows.shape[1]), dtype=np.float32)
+
+        need = self._n + len(rows)
+
+        if self._lo + need > len(self._vec_buf):
+
+            cap = max(16, 2 * need)
+
+            buf = np.zeros((cap, rows.shape[1]), dtype=np.float32)
+
+            buf[:self._n] = self._vectors
+
+            rid_buf = np.zeros(cap, dtype=np.int64)
+
+            rid_buf[:self._n] = self._rids
+
+            self._vec_buf, self._rid_buf = buf, rid_buf
+
+            self._rows_shared = False
+
+            self._lo = 0
+
+        self._vec_buf[self._lo + self._n:self._lo + need] = rows
+
+        self._rid_buf[self._lo + self._n:self._lo + need] = rids
+
+        self._n = need
+
+
+
+    def _positions(self, rids) -> np.ndarray:
+
+        rids = np.asarray(rids, dtype=np.int64)
+
+        if self._n == 0:
+
+            return np.full(len(rids), -1, dtype=np.int64)
+
+        pos = np.minimum(np.searchsorted(self._rids, rids), self._n - 1)
+
+        return np.where(self._rids[pos] == rids, pos, -1)
+
+
+
+    def _decode_vectors(self, rows: List[Tuple[int, Optional[bytes]]]) -> Tuple[np.ndarray, np.ndarray]:
+
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+
+        mat = np.zeros((len(rows), self._dim), dtype=np.float32)
+
+        ok = [i for i, r in enumerate(rows) if r[1] and len(r[1]) == 4 * self._dim]
+
+        if ok:
+
+            mat[ok] = _blobs_to_matrix([rows[i][1] for i in ok])
+
+        return ids, mat
+
+
+
+    def _fetch_vectors(self, rids: np.ndarray, conn: Optional[sqlite3.Connection] = None) -> np.ndarray:
+
+        conn = conn or self._conn()
+
+        rids = np.asarray(rids, dtype=np.int64)
+
+        out = np.zeros((len(rids), self._dim), dtype=np.float32)
+
+        order = np.argsort(rids)
+
+        for i in range(0, len(rids), SQLITE_MAX_VARS):
+
+            chunk = rids[order[i:i + SQLITE_MAX_VARS]].tolist()
+
+            rows = conn.execute(f"SELECT rid, embedding FROM memories WHERE rid IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+
+            if rows:
+
+                ids, mat = self._decode_vectors(rows)
+
+                pos = np.searchsorted(rids, ids, sorter=order)
+
+                out[order[pos]] = mat
+
+        return out
+
+
+
+    def _iter_vectors(self, conn: Optional[sqlite3.Connection] = None, upto: Optional[int] = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+
+        conn = conn or self._conn()
+
+        last = -1
+
+        while True:
+
+            rows = conn.execute("SELECT rid, embedding FROM memories WHERE rid > ? AND rid <= ? ORDER BY rid LIMIT ?",
+
+                                (last, upto if upto is not None else 2 ** 62, VECTOR_SCAN_BATCH)).fetchall()
+
+            if not rows:
+
+                return
+
+            last = rows[-1][0]
+
+            yield self._decode_vectors(rows)
+
+
+
+    def _build_index(self, kind: str, rids: np.ndarray, vecs: Optional[np.ndarray]):
+
+        if vecs is not None:
+
+            return _build_faiss_index(kind, vecs, rids, self.index_config)
+
+        cfg = self.index_config
+
+        n = len(rids)
+
+        sample_rids = rids
+
+        if n > cfg.train_sample:
+
+            sample_rids = np.sort(np.random.default_rng(0).choice(rids, cfg.train_sample, replace=False))
+
+        conn = sqlite3.connect(self.sqlite_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None)
+
+        try:
+
+            index = _new_faiss_index(kind, cfg.quantizer_for(n), self._dim, n, self._fetch_vectors(sample_rids, conn), cfg)
+
+            if n:
+
+                for ids, mat in self._iter_vectors(conn, upto=int(rids[-1])):
+
+                    index.add_with_ids(mat, ids)
+
+        finally:
+
+            conn.close()
+
+        return index
+
+
+
+    def _drop_rids(self, rids: List[int]):
+
+        pos = self._positions(rids)
+
+        pos = np.unique(pos[pos >= 0])
+
+        if len(pos) == 0:
+
+            return
+
+        self._cache.discard(rids)
+
+        self._compact_rows(pos)
+
+        if FAISS_AVAILABLE and (self._index is not None or self._rebuild_delta is not None):
+
+            try:
+
+                self._apply_index(IndexJournal.OP_REMOVE, np.asarray(rids, dtype=np.int64))
+
+            except Exception:
+
+                self._init_faiss(rebuild=True)
+
+
+
+    def _index_add(self, index, rids: np.ndarray, vecs: np.ndarray, dead: set, replace_existing: bool = False):
+
+        if replace_existing:
+
+            self._index_remove(index, rids, dead)
+
+        index.add_with_ids(np.ascontiguousarray(vecs, dtype=np.float32), rids)
+
+
+
+    def _index_remove(self, index, rids: np.ndarray, dead: set):
+
+        if _index_kind(index) == "hnsw":
+
+            labels = np.nonzero(np.isin(faiss.vector_to_array(index.id_map), rids))[0]
+
+            dead.update(labels.tolist())
+
+        else:
+
+            index.remove_ids(rids)
+
+
+
+    def _apply_index(self, op: int, rids: np.ndarray, vecs: Optional[np.ndarray] = None, replace_existing: bool = False):
+
+        if self._index is not None:
+
+            if op == IndexJournal.OP_ADD:
+
+                self._index_add(self._index, rids, vecs, self._dead_labels, replace_existing)
+
+            else:
+
+                self._index_remove(self._index, rids, self._dead_labels)
+
+            self._log_index(op, rids, vecs)
+
+        if self._rebuild_delta is not None:
+
+            self._rebuild_delta.append((op, rids, vecs, replace_existing))
+
+        self._maybe_rebuild()
+
+
+
+    def _patch_loaded(self, index) -> int:
+
+        ids = _faiss_ids(index)
+
+        dead: set = set()
+
+        if _index_kind(index) == "hnsw":
+
+            _, last = np.unique(ids[::-1], return_index=True)
+
+            live = np.zeros(len(ids), dtype=bool)
+
+            live[len(ids) - 1 - last] = True
+
+            dead = set(np.nonzero(~live)[0].tolist())
+
+            ids = ids[live]
+
+        elif len(np.unique(ids)) != len(ids):
+
+            return -1
+
+        stale = ids[~np.isin(ids, self._rids)]
+
+        missing = self._rids[~np.isin(self._rids, ids)]
+
+        drift = len(stale) + len(missing)
+
+        if drift > INDEX_PATCH_MAX_RATIO * max(self._n, len(ids), 16):
+
+            return -1
+
+        if len(stale):
+
+            self._index_remove(index, stale, dead)
+
+        if len(missing):
+
+            vecs = self._fetch_vectors(missing) if self._quantized else self._vectors[self._positions(missing)]
+
+            self._index_add(index, missing, vecs, dead)
+
+        self._dead_labels = dead
+
+        return drift
+
+
+
+    @property
+
+    def _manifest_path(self) -> Path:
+
+        return Path(str(self.faiss_index_path) + ".manifest.json")
+
+
+
+    def _manifest(self, data: np.ndarray, conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
+
+        return {
+
+            "version": INDEX_MANIFEST_VERSION, "rows": self._n, "last_rid": int(self._rids[-1]) if self._n else 0,
+
+            "rid_digest": _rid_digest(self._rids), "embedding_model": self._latest_model(conn),
+
+            "dim": int(self._index.d), "kind": _index_kind(self._index), "quantizer": _index_quantizer(self._index),
+
+            "bytes": int(len(data)), "crc32": f"{zlib.crc32(data):08x}",
+
+        }
+
+
+
+    def _write_manifest(self, manifest: Dict[str, Any]):
+
+        tmp = Path(str(self._manifest_path) + ".tmp")
+
+        tmp.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+        os.replace(tmp, self._manifest_path)
+
+
+
+    def _load_checked_index(self, journal: IndexJournal) -> Tuple[Optional[Any], str]:
+
+        if not self.faiss_index_path.exists():
+
+            return None, "missing"
+
+        try:
+
+            manifest = json.loads(self._manifest_path.read_text(encoding="utf-8"))
+
+        except Exception:
+
+            return None, "no_manifest"
+
+        if manifest.get("version") != INDEX_MANIFEST_VERSION:
+
+            return None, "manifest_version"
+
+        data = np.fromfile(self.faiss_index_path, dtype=np.uint8)
+
+        if len(data) != manifest.get("bytes") or f"{zlib.crc32(data):08x}" != manifest.get("crc32"):
+
+            return None, "checksum"
+
+        if manifest.get("dim") != self._dim or manifest.get("dim") != journal.dim:
+
+            return None, "dim"
+
+        if self._n and manifest.get("embedding_model") != self._latest_model():
+
+            return None, "embedding_model"
+
+        index = faiss.deserialize_index(data)
+
+        scratch: set = set()
+
+        replayed = journal.replay(lambda op, ids, v: self._index_add(index, ids, v, scratch, True)
+
+                                  if op == IndexJournal.OP_ADD else self._index_remove(index, ids, scratch))
+
+        if replayed < 0:
+
+            return None, "journal"
+
+        if (not replayed and _index_kind(index) != "hnsw" and manifest.get("rows") == self._n
+
+                and manifest.get("last_rid") == (int(self._rids[-1]) if self._n else 0) and manifest.get("rid_digest") == _rid_digest(self._rids)):
+
+            self._dead_labels = set()
+
+            return index, "ok"
+
+        patched = self._patch_loaded(index)
+
+        if patched < 0:
+
+            return None, "drift"
+
+        if replayed:
+
+            log_action("memory_index_replay", {"records": replayed})
+
+        if patched:
+
+            log_action("memory_index_patch", {"rows": patched, "manifest_rows": manifest.get("rows"), "rows_now": self._n})
+
+        return index, "patched" if patched else "ok"
+
+
+
+    def _index_search(self, qvecs: np.ndarray, k: int, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+
+        index = self._index
+
+        kind = _index_kind(index)
+
+        if kind != "hnsw":
+
+            if allowed is None:
+
+                return index.search(qvecs, k)
+
+            sel = faiss.IDSelectorBatch(allowed)
+
+            params = faiss.SearchParametersIVF(sel=sel, nprobe=index.nprobe) if kind == "ivf" else faiss.SearchParameters(sel=sel)
+
+            return index.search(qvecs, k, params=params)
+
+        inner = faiss.downcast_index(index.index)
+
+        if allowed is not None:
+
+            id_map = faiss.rev_swig_ptr(index.id_map.data(), index.id_map.size())
+
+            labels = np.nonzero(np.isin(id_map, allowed))[0]
+
+            if self._dead_labels:
+
+                labels = labels[~np.isin(labels, np.fromiter(self._dead_labels, dtype=np.int64, count=len(self._dead_labels)))]
+
+            sel = faiss.IDSelectorBatch(labels)
+
+            D, L = inner.search(qvecs, k, params=faiss.SearchParametersHNSW(sel=sel, efSearch=max(self.index_config.ef_search, k)))
+
+            return D, np.where(L >= 0, id_map[np.maximum(L, 0)], -1)
+
+        if not self._dead_labels:
+
+            inner.hnsw.efSearch = max(self.index_config.ef_search, k)
+
+            return index.search(qvecs, k)
+
+        dead = np.fromiter(self._dead_labels, dtype=np.int64, count=len(self._dead_labels))
+
+        id_map = faiss.rev_swig_ptr(index.id_map.data(), index.id_map.size())
+
+        fetch = min(index.ntotal, 2 * k + 16)
+
+        while True:
+
+            inner.hnsw.efSearch = max(self.index_config.ef_search, fetch)
+
+            D, L = inner.search(qvecs, fetch)
+
+            ok = (L >= 0) & ~np.isin(L, dead)
+
+            if fetch >= index.ntotal or ok.sum(axis=1).min() >= k:
+
+                break
+
+            fetch = min(index.ntotal, fetch * 4)
+
+        out_D = np.full((len(qvecs), k), -np.inf, dtype=np.float32)
+
+        out_I = np.full((len(qvecs), k), -1, dtype=np.int64)
+
+        for row in range(len(qvecs)):
+
+            sel = np.nonzero(ok[row])[0][:k]
+
+            out_D[row, :len(sel)] = D[row, sel]
+
+            out_I[row, :len(sel)] = id_map[L[row, sel]]
+
+        return out_D, out_I
+
+
+
+    def tune_index(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+
+        with self.lock:
+
+            if nprobe is not None:
+
+                self.index_config.nprobe = int(nprobe)
+
+            if ef_search is not None:
+
+                self.index_config.ef_search = int(ef_search)
+
+            if self._index is not None:
+
+                _tune_faiss_index(self._index, self.index_config)
+
+
+
+    def index_info(self) -> Dict[str, Any]:
+
+        with self.lock:
+
+            if self._index is None:
+
+                return {"kind": None, "ntotal": 0, "rows": self._n, "rebuilding": self._rebuild_thread is not None}
+
+            info = {"kind": _index_kind(self._index), "ntotal": int(self._index.ntotal), "rows": self._n,
+
+                    "dead": len(self._dead_labels), "rebuilding": self._rebuild_thread is not None}
+
+            if info["kind"] == "ivf":
+
+                info.update(nlist=int(self._index.nlist), nprobe=int(self._index.nprobe))
+
+            elif info["kind"] == "hnsw":
+
+                info.update(ef_search=self.index_config.ef_search)
+
+            info["quantizer"] = _index_quantizer(self._index)
+
+            info["bytes_per_vector"] = int(_code_index(self._index).sa_code_size())
+
+            return info
+
+
+
+    def _maybe_rebuild(self):
+
+        if self._index is None or self._rebuild_thread is not None:
+
+            return
+
+        cfg = self.index_config
+
+        kind = _index_kind(self._index)
+
+        want = cfg.kind_for(self._n)
+
+        rank = {k: i for i, k in enumerate(INDEX_KINDS)}
+
+        if rank[want] < rank[kind] and rank[cfg.kind_for(2 * self._n)] >= rank[kind]:
+
+            want = kind
+
+        quant = _index_quantizer(self._index)
+
+        want_quant = cfg.quantizer_for(self._n) if self._quantized else "none"
+
+        if want_quant == "sq8" and quant == "pq" and cfg.quantizer_for(2 * self._n) == "pq":
+
+            want_quant = quant
+
+        reason = None
+
+        if want != kind:
+
+            reason = f"{kind}->{want}"
+
+        elif want_quant != quant:
+
+            reason = f"{quant}->{want_quant}"
+
+        elif kind == "ivf" and cfg.nlist_for(self._n) >= cfg.rebuild_growth * self._index.nlist:
+
+            reason = "ivf_growth"
+
+        elif kind == "hnsw" and len(self._dead_labels) > cfg.max_dead_ratio * max(1, self._index.ntotal):
+
+            reason = "hnsw_tombstones"
+
+        if reason:
+
+            self._start_rebuild(want, reason)
+
+
+
+    def _start_rebuild(self, kind: str, reason: str):
+
+        self._rebuild_delta = []
+
+        snapshot = (self._rids.copy(), None if self._quantized else self._vectors)
+
+        self._rows_shared = not self._quantized
+
+        self._rebuild_thread = threading.Thread(target=self._rebuild_index, args=(kind, reason, snapshot),
+
+                                                name="memory-index-rebuild", daemon=True)
+
+        self._rebuild_thread.start()
+
+
+
+    def _rebuild_index(self, kind: str, reason: str, snapshot: Tuple[np.ndarray, np.ndarray]):
+
+        try:
+
+            t0 = time.perf_counter()
+
+            rids, vecs = snapshot
+
+            index = self._build_index(kind, rids, vecs)
+
+            with self.lock:
+
+                if self._rebuild_delta is None:
+
+                    return
+
+                dead: set = set()
+
+                for op, ids, v, replace_existing in self._rebuild_delta:
+
+                    if op == IndexJournal.OP_ADD:
+
+                        self._index_add(index, ids, v, dead, replace_existing)
+
+                    else:
+
+                        self._index_remove(index, ids, dead)
+
+                self._index, self._dead_labels = index, dead
+
+                self._rebuild_delta = None
+
+            conn = sqlite3.connect(self.sqlite_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None)
+
+            try:
+
+                self._checkpoint(force=True, conn=conn)
+
+            finally:
+
+                conn.close()
+
+            log_action("memory_index_rebuild", {"kind": kind, "reason": reason, "rows": len(rids),
+
+                                                "secs": round(time.perf_counter() - t0, 3)})
+
+        except Exception as e:
+
+            log_action("memory_index_rebuild_error", {"kind": kind, "err": str(e)}, "error")
+
+        finally:
+
+            with self.lock:
+
+                self._rebuild_delta = None
+
+                self._rebuild_thread = None
+
+
+
+    def _journal_for(self, dim: int) -> Optional[IndexJournal]:
+
+        if not self.faiss_index_path:
+
+            return None
+
+        if self._journal is None or self._journal.dim != dim:
+
+            if self._journal is not None:
+
+                self._journal.close()
+
+            self._journal = IndexJournal(Path(str(self.faiss_index_path) + ".journal"), dim)
+
+        return self._journal
+
+
+
+    def _init_faiss(self, rebuild: bool = False):
+
+        with self.lock:
+
+            self._index = None
+
+            self._dead_labels = set()
+
+            self._rebuild_delta = None
+
+            if not FAISS_AVAILABLE or not self._n:
+
+                return
+
+            kind = self.index_config.kind_for(self._n)
+
+            try:
+
+                journal = self._journal_for(self._dim)
+
+                if not rebuild and journal is not None:
+
+                    index, status = self._load_checked_index(journal)
+
+                    if index is not None:
+
+                        _tune_faiss_index(index, self.index_config)
+
+                        self._index = index
+
+                        if status == "patched":
+
+                            self._save_faiss()
+
+                        self._maybe_rebuild()
+
+                        return
+
+                    log_action("memory_index_rebuild_scheduled", {"reason": status, "rows": self._n})
+
+                    self._start_rebuild(kind, status)
+
+                    return
+
+                self._index = self._build_index("flat", self._rids, None if self._quantized else self._vectors)
+
+                self._save_faiss()
+
+                self._maybe_rebuild()
+
+            except Exception:
+
+                self._index = None
+
+
+
+    def _save_faiss(self):
+
+        with self.lock:
+
+            if not (FAISS_AVAILABLE and self._index is not None and self.faiss_index_path):
+
+                return
+
+            try:
+
+                data = faiss.serialize_index(self._index)
+
+                tmp = Path(str(self.faiss_index_path) + ".tmp")
+
+                data.tofile(str(tmp))
+
+                os.replace(tmp, self.faiss_index_path)
+
+                self._write_manifest(self._manifest(data))
+
+                self._journal_for(self._index.d).reset()
+
+                self._index_gen += 1
+
+                self._last_checkpoint = time.monotonic()
+
+            except Exception:
+
+                pass
+
+
+
+    def _log_index(self, op: int, rids: np.ndarray, vecs: Optional[np.ndarray] = None):
+
+        journal = self._journal_for(self._index.d)
+
+        if journal is None:
+
+            return
+
+        try:
+
+            journal.append(op, rids, vecs)
+
+        except Exception:
+
+            self._save_faiss()
+
+            return
+
+        if journal.size() >= INDEX_JOURNAL_MAX_BYTES:
+
+            self._flush_wake.set()
+
+
+
+    def _checkpoint(self, force: bool = False, conn: Optional[sqlite3.Connection] = None):
+
+        with self._ckpt_lock:
+
+            with self.lock:
+
+                journal = self._journal
+
+                if self._index is None or journal is None or not (force or journal.pending()):
+
+                    return
+
+                data = faiss.serialize_index(self._index)
+
+                manifest = self._manifest(data, conn)
+
+                upto = journal.size()
+
+                gen = self._index_gen
+
+            try:
+
+                tmp = Path(str(self.faiss_index_path) + ".ckpt")
+
+                with open(tmp, "wb") as f:
+
+                    data.tofile(f)
+
+                    f.flush()
+
+                    os.fsync(f.fileno())
+
+                with self.lock:
+
+                    if gen != self._index_gen or journal is not self._journal:
+
+                        tmp.unlink()
+
+                        return
+
+                    os.replace(tmp, self.faiss_index_path)
+
+                    self._write_manifest(manifest)
+
+                    journal.truncate_before(upto)
+
+                    self._index_gen += 1
+
+                    self._last_checkpoint = time.monotonic()
+
+            except Exception as e:
+
+                log_action("memory_index_checkpoint_error", {"err": str(e)}, "warn")
+
+
+
+    def _flush_loop(self):
+
+        while not self._flush_stop.is_set():
+
+            self._flush_wake.wait(timeout=max(1.0, INDEX_CHECKPOINT_SECS / 4))
+
+            self._flush_wake.clear()
+
+            if self._flush_stop.is_set():
+
+                break
+
+            with self.lock:
+
+                journal = self._journal
+
+                if journal is None or not journal.pending():
+
+                    continue
+
+                due = time.monotonic() - self._last_checkpoint >= INDEX_CHECKPOINT_SECS
+
+                full = journal.size() >= INDEX_JOURNAL_MAX_BYTES
+
+            if due or full:
+
+                self._checkpoint()
+
+
+
+    def _new_entry(self, text: str, tags: Optional[List[str]], meta: Optional[Dict[str, Any]], vec: np.ndarray) -> MemoryEntry:
+
+        meta = meta or {}
+
+        return MemoryEntry(
+
+            id=str(meta.get("id") or uuid.uuid4()), text=text, tags=tags or [],
+
+            created_at=meta.get("created_at") or datetime.now(timezone.utc).isoformat(),
+
+            embedding_model=self.embedder.model_used, embedding=vec,
+
+            importance=min(1.0, max(0.0, float(meta.get("importance", DEFAULT_IMPORTANCE))))
+
+        )
+
+
+
+    def _store_entries(self, entries: List[MemoryEntry]):
+
+        with self._write_lock:
+
+            with self._write() as conn:
+
+                conn.executemany(
+
+                    "INSERT INTO memories (id, text, tags, created_at, embedding, embedding_model, created_ts, importance, text_hash) "
+
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+
+                    "ON CONFLICT(id) DO UPDATE SET text = excluded.text, tags = excluded.tags, created_at = excluded.created_at, "
+
+                    "embedding = excluded.embedding, embedding_model = excluded.embedding_model, created_ts = excluded.created_ts, "
+
+                    "importance = excluded.importance, text_hash = excluded.text_hash",
+
+                    [(e.id, e.text, json.dumps(e.tags), e.created_at, _float32_to_blob(e.embedding), e.embedding_model, _created_ts(e.created_at),
+
+                      e.importance, text_key(e.text)) for e in entries]
+
+                )
+
+                ids = list({e.id for e in entries})
+
+                rid_of: Dict[str, int] = {}
+
+                for i in range(0, len(ids), SQLITE_MAX_VARS):
+
+                    chunk = ids[i:i + SQLITE_MAX_VARS]
+
+                    rid_of.update(conn.execute(
+
+                        f"SELECT id, rid FROM memories WHERE id IN ({','.join('?' * len(chunk))})", chunk
+
+                    ).fetchall())
+
+            latest: Dict[int, MemoryEntry] = {}
+
+            for e in entries:
+
+                e.rid = rid_of[e.id]
+
+                latest[e.rid] = e
+
+            rids = np.array(sorted(latest), dtype=np.int64)
+
+            vecs = np.vstack([latest[r].embedding for r in rids]).astype(np.float32)
+
+            with self.lock:
+
+                self._publish_entries(latest, rids, vecs)
+
+
+
+    def _publish_entries(self, latest: Dict[int, MemoryEntry], rids: np.ndarray, vecs: np.ndarray):
+
+        pos = self._positions(rids)
+
+        old = pos >= 0
+
+        for e in latest.values():
+
+            self._cache.put(replace(e, embedding=None))
+
+        if old.any():
+
+            self._vectors[pos[old]] = self._resident(vecs[old])
+
+        if (~old).any():
+
+            self._append_rows(rids[~old], vecs[~old])
+
+        if FAISS_AVAILABLE:
+
+            try:
+
+                if self._index is None and self._rebuild_thread is None:
+
+                    self._init_faiss(rebuild=True)
+
+                else:
+
+                    if old.any():
+
+                        self._apply_index(IndexJournal.OP_ADD, rids[old], vecs[old], replace_existing=True)
+
+                    if (~old).any():
+
+                        self._apply_index(IndexJournal.OP_ADD, rids[~old], vecs[~old])
+
+            except Exception:
+
+                pass
+
+
+
+    def add_memory(self, text: str, tags: Optional[List[str]] = None, meta: Optional[Dict[str, Any]] = None,
+
+                   dedup: Optional[bool] = None, threshold: float = DEDUP_THRESHOLD) -> MemoryEntry:
+
+        dedup = DEDUP if dedup is None else dedup
+
+        vec = None
+
+        if dedup and not (meta or {}).get("id"):
+
+            rid = self._exact_duplicate(text)
+
+            if rid is None:
+
+                vec = self.embedder.embed_texts([text])[0]
+
+                rid = self._near_duplicate(vec, threshold)
+
+            entry = self._merge_duplicate(rid, tags, meta) if rid is not None else None
+
+            if entry is not None:
+
+                log_action("memory_dedup", {"id": entry.id, "hits": entry.hit_count, "exact": vec is None})
+
+                return entry
+
+        if vec is None:
+
+            vec = self.embedder.embed_texts([text])[0]
+
+        entry = self._new_entry(text, tags, meta, vec)
+
+        self._store_entries([entry])
+
+        log_action("memory_add", {"id": entry.id, "len": len(text)})
+
+        return entry
+
+
+
+    def _exact_duplicate(self, text: str) -> Optional[int]:
+
+        row = self._conn().execute("SELECT rid FROM memories WHERE text_hash = ? AND text = ? LIMIT 1", (text_key(text), text)).fetchone()
+
+        return row[0] if row else None
+
+
+
+    def _near_duplicate(self, vec: np.ndarray, threshold: float) -> Optional[int]:
+
+        rids, scores = self._vector_candidates(vec, 1)
+
+        if len(rids) and float(scores[0]) >= threshold:
+
+            return int(rids[0])
+
+        return None
+
+
+
+    def _merge_duplicate(self, rid: int, tags: Optional[List[str]], meta: Optional[Dict[str, Any]]) -> Optional[MemoryEntry]:
+
+        with self._write_lock:
+
+            with self.lock:
+
+                current = self._entries([rid]).get(rid)
+
+            if current is None:
+
+                return None
+
+            merged_tags = list(dict.fromkeys(list(current.tags) + list(tags or [])))
+
+            importance = max(current.importance, min(1.0, max(0.0, float((meta or {}).get("importance", current.importance)))))
+
+            with self._write() as conn:
+
+                conn.execute("UPDATE memories SET hit_count = coalesce(hit_count, 1) + 1, last_seen_ts = ?, importance = ? WHERE rid = ?",
+
+                             (time.time(), importance, rid))
+
+                if merged_tags != list(current.tags):
+
+                    conn.execute("UPDATE memories SET tags = ? WHERE rid = ?", (json.dumps(merged_tags), rid))
+
+            with self.lock:
+
+                self._cache.discard([rid])
+
+                return self._entries([rid]).get(rid)
+
+
+
+    def add_memories(self, texts: List[str], tags: Optional[List[Optional[List[str]]]] = None,
+
+                     metas: Optional[List[Optional[Dict[str, Any]]]] = None, batch_size: int = INGEST_BATCH_SIZE,
+
+                     updater: Optional[Callable[[int, int], None]] = None) -> List[MemoryEntry]:
+
+        total = len(texts)
+
+        tags = tags if tags is not None else [None] * total
+
+        metas = metas if metas is not None else [None] * total
+
+        if len(tags) != total or len(metas) != total:
+
+            raise ValueError("tags and metas must have one item per text")
+
+        batch_size = max(1, int(batch_size))
+
+        out: List[MemoryEntry] = []
+
+        for i in range(0, total, batch_size):
+
+            batch = texts[i:i + batch_size]
+
+            vecs = self.embedder.embed_texts(batch)
+
+            entries = [self._new_entry(t, tg, mt, v) for t, tg, mt, v in zip(batch, tags[i:i + batch_size], metas[i:i + batch_size], vecs)]
+
+            self._store_entries(entries)
+
+            out.extend(entries)
+
+            if updater:
+
+                updater(len(out), total)
+
+        if out:
+
+            log_action("memory_add_batch", {"count": len(out)})
+
+        return out
+
+
+
+    def list_memories(self, limit: int = 200, include_embedding: bool = False) -> List[Dict[str, Any]]:
+
+        return self.list_page(limit, include_embedding=include_embedding)[0]
+
+
+
+    def count(self, tags: Optional[List[str]] = None) -> int:
+
+        if not tags:
+
+            return self._n
+
+        clause, params = _filter_sql(tags)
+
+        return int(self._conn().execute(f"SELECT count(*) FROM memories WHERE {clause}", params).fetchone()[0])
 
-import base64
 
-import uuid
 
-import threading
+    def list_page(self, limit: int = 200, cursor: Optional[str] = None, tags: Optional[List[str]] = None,
 
-import shutil              
+                  include_embedding: bool = False) -> Tuple[List[Dict[str, Any]], Optional[str]]:
 
-from dataclasses import dataclass, asdict
+        limit = max(0, int(limit))
 
-from typing import List, Dict, Any, Optional, Callable, Tuple
+        clause, params = _filter_sql(tags)
 
-from pathlib import Path
+        extra = f" AND {clause}" if clause else ""
 
-from datetime import datetime, timezone
+        columns = f"{ROW_COLUMNS}, created_ts" + (", embedding" if include_embedding else "")
 
+        ts, rid = _parse_cursor(cursor)
 
+        conn = self._conn()
 
-import requests
+        rows = []
 
-import numpy as np
+        if ts is not None or cursor is None:
 
-from .utils.logging import log_action                                      
+            keyset = "(created_ts, rid) < (?, ?)" if cursor is not None else "created_ts IS NOT NULL"
 
+            rows = conn.execute(
 
+                f"SELECT {columns} FROM memories WHERE {keyset}{extra} ORDER BY created_ts DESC, rid DESC LIMIT ?",
 
-                  
+                ([ts, rid] if cursor is not None else []) + params + [limit]
 
-try:
+            ).fetchall()
 
-    import faiss
+        if len(rows) < limit:
 
-    FAISS_AVAILABLE = True
+            before = rid if ts is None and cursor is not None else None
 
-except Exception:
+            keyset = "created_ts IS NULL" + (" AND rid < ?" if before is not None else "")
 
-    faiss = None
+            rows += conn.execute(
 
-    FAISS_AVAILABLE = False
+                f"SELECT {columns} FROM memories WHERE {keyset}{extra} ORDER BY rid DESC LIMIT ?",
 
+                ([before] if before is not None else []) + params + [limit - len(rows)]
 
+            ).fetchall()
 
-try:
+        out = []
 
-    from sentence_transformers import SentenceTransformer
+        for r in rows:
 
-    ST_AVAILABLE = True
+            entry = _row_entry(r)
 
-except Exception:
+            if include_embedding:
 
-    SentenceTransformer = None
+                entry = replace(entry, embedding=_blob_to_float32(r[9]))
 
-    ST_AVAILABLE = False
+            out.append(entry.to_dict(include_embedding))
 
+        next_cursor = _make_cursor(rows[-1][8], rows[-1][0]) if rows and len(rows) == limit else None
 
+        return out, next_cursor                           
 
-           
 
-ROOT = Path(__file__).resolve().parents[1]
 
-DB_DIR = ROOT / "db"
+    def search(self, query: str, k: int = 6, mode: Optional[str] = None, tags: Optional[List[str]] = None,
 
-DB_DIR.mkdir(parents=True, exist_ok=True)
+               since: Any = None, until: Any = None, half_life_days: Optional[float] = None,
 
-SQLITE_PATH = DB_DIR / "memories.sqlite"
+               mmr_lambda: Optional[float] = None) -> List[Dict[str, Any]]:
 
-FAISS_INDEX_PATH = DB_DIR / "faiss.index"
+        return self.search_many([query], k, mode, tags, since, until, half_life_days, mmr_lambda)[0]
 
-DEFAULT_EMBED_URL = os.environ.get("MAINMI_EMBED_URL", "http://127.0.0.1:9000/embed")
 
-DEFAULT_EMBED_MODEL_NAME = os.environ.get("MAINMI_EMBED_MODEL", "all-MiniLM-L6-v2")
 
-DEFAULT_DIM = 384
+    def search_many(self, queries: List[str], k: int = 6, mode: Optional[str] = None, tags: Optional[List[str]] = None,
 
-SQLITE_TIMEOUT = 30
+                    since: Any = None, until: Any = None, half_life_days: Optional[float] = None,
 
+                    mmr_lambda: Optional[float] = None) -> List[List[Dict[str, Any]]]:
 
+        mode = mode or SEARCH_MODE
 
-          
+        if mode not in SEARCH_MODES:
 
-def _float32_to_b64(x: np.ndarray) -> str:
+            raise ValueError(f"unknown search mode: {mode}")
 
-    return base64.b64encode(x.astype(np.float32).tobytes()).decode("ascii")
+        if mmr_lambda is not None and not 0.0 <= mmr_lambda <= 1.0:
 
+            raise ValueError("mmr_lambda must be between 0 and 1")
 
+        if not queries:
 
-def _b64_to_float32(s: str) -> np.ndarray:
+            return []
 
-    b = base64.b64decode(s.encode("ascii"))
+        where = _filter_sql(tags, since, until)
 
-    return np.frombuffer(b, dtype=np.float32).copy()
+        half_life = RECENCY_HALF_LIFE_DAYS if half_life_days is None else float(half_life_days)
 
+        if (half_life <= 0 and mmr_lambda is None) or k <= 0:
 
+            return self._hits_many(self._candidates(queries, k, mode, where))
 
-def _normalize(vecs: np.ndarray) -> np.ndarray:
+        depth = max(k, SEARCH_CANDIDATES) if mmr_lambda is None else max(k, MMR_CANDIDATES)
 
-    norms = np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-12
+        ranked = self._candidates(queries, depth, mode, where)
 
-    return (vecs / norms).astype("float32")
+        if half_life > 0:
 
+            ranked = [self._recency_rerank(rids, scores, depth if mmr_lambda is not None else k, half_life) for rids, scores in ranked]
 
+        if mmr_lambda is not None:
 
-               
+            ranked = self._diversify(ranked, k, mmr_lambda)
 
-@dataclass
+        return self._hits_many(ranked)
 
-class MemoryEntry:
 
-    id: str
 
-    text: str
+    def _diversify(self, ranked: List[Tuple[np.ndarray, np.ndarray]], k: int, lam: float) -> List[Tuple[np.ndarray, np.ndarray]]:
 
-    tags: List[str]
+        uniq = np.unique(np.concatenate([rids for rids, _ in ranked]).astype(np.int64))
 
-    created_at: str
+        with self.lock:
 
-    embedding_b64: str
+            if self._quantized:
 
-    embedding_model: str
+                vecs = self._fetch_vectors(uniq)
 
+            else:
 
+                pos = self._positions(uniq)
 
-    def to_dict(self) -> Dict[str, Any]:
+                vecs = np.zeros((len(uniq), self._vectors.shape[1]), dtype=np.float32)
 
-        return asdict(self)
+                vecs[pos >= 0] = self._vectors[pos[pos >= 0]]
 
+        out = []
 
+        for rids, scores in ranked:
 
-             
+            if len(rids) <= 1:
 
-class Embedder:
+                out.append((rids, scores))
 
-    def __init__(self, service_url: str = DEFAULT_EMBED_URL, local_model_name: str = DEFAULT_EMBED_MODEL_NAME):
+                continue
 
-        self.service_url = service_url
+            span = float(scores.max() - scores.min())
 
-        self.local_model_name = local_model_name
+            relevance = (scores - scores.min()) / span if span > 0 else np.ones(len(scores), dtype=np.float32)
 
-        self._local_model = None
+            top = _mmr(relevance, vecs[np.searchsorted(uniq, rids)], k, lam)
 
-        self._dim = DEFAULT_DIM
+            out.append((rids[top], scores[top]))
 
+        return out
 
 
-    def _ensure_local(self):
 
-        if self._local_model is None and ST_AVAILABLE:
+    def _candidates(self, queries: List[str], k: int, mode: str, where: Tuple[str, List[Any]]) -> List[Tuple[np.ndarray, np.ndarray]]:
 
-            try:
+        if mode == "vector" or not FTS_AVAILABLE or k <= 0:
 
-                self._local_model = SentenceTransformer(self.local_model_name)
+            return self._vector_candidates_many(self.embedder.embed_texts(queries), k, self._filter_rids(where))
 
-            except Exception:
+        if mode == "lexical":
 
-                self._local_model = None
+            return [self._lexical_candidates(q, k, where) for q in queries]
 
+        out: List[Optional[Tuple[np.ndarray, np.ndarray]]] = [None] * len(queries)
 
+        if LEXICAL_SHORTCIRCUIT_TERMS > 0:
 
-    @property
+            for i, q in enumerate(queries):
 
-    def model_used(self) -> str:
+                if not _identifier_query(q):
 
-        if self._local_model:
+                    continue
 
-            return self.local_model_name
+                rids, scores = self._lexical_candidates(q, k, where, match_all=True, max_terms=LEXICAL_SHORTCIRCUIT_TERMS)
 
-        if self.service_url:
+                if len(rids):
 
-            return "embed_service"
+                    out[i] = rids, scores
 
-        return "char_fallback"
+        pending = [i for i, r in enumerate(out) if r is None]
 
+        if pending:
 
+            depth = max(k, SEARCH_CANDIDATES)
 
-    def embed_texts(self, texts: List[str], timeout: int = 60) -> np.ndarray:
+            vec = self._vector_candidates_many(self.embedder.embed_texts([queries[i] for i in pending]), depth, self._filter_rids(where))
 
-        if self.service_url:
+            for i, (vec_rids, _) in zip(pending, vec):
 
-            try:
+                lex_rids, _ = self._lexical_candidates(queries[i], depth, where)
 
-                r = requests.post(self.service_url, json={"texts": texts}, timeout=timeout)
+                out[i] = self._fuse([vec_rids, lex_rids], k)
 
-                r.raise_for_status()
+        return out
 
-                j = r.json()
 
-                arrs = j.get("embeddings") or j.get("embedding") or None
 
-                if arrs is not None:
+    def _recency_rerank(self, rids: np.ndarray, scores: np.ndarray, k: int, half_life_days: float) -> Tuple[np.ndarray, np.ndarray]:
 
-                    a = np.asarray(arrs, dtype=np.float32)
+        if len(rids) == 0:
 
-                    return _normalize(a)
+            return rids, scores
 
-            except Exception:
+        found: Dict[int, Tuple[Optional[float], Optional[float]]] = {}
 
-                pass
+        for i in range(0, len(rids), SQLITE_MAX_VARS):
 
-        self._ensure_local()
+            chunk = [int(r) for r in rids[i:i + SQLITE_MAX_VARS]]
 
-        if self._local_model is not None:
+            for rid, ts, imp in self._conn().execute(
 
-            a = self._local_model.encode(texts, convert_to_numpy=True)
+                    f"SELECT rid, coalesce(last_seen_ts, created_ts), importance FROM memories WHERE rid IN ({','.join('?' * len(chunk))})", chunk):
 
-            return _normalize(np.asarray(a, dtype=np.float32))
+                found[rid] = (ts, imp)
 
-        vecs = []
+        created = np.array([found.get(int(r), (None, None))[0] for r in rids], dtype=np.float64)
 
-        for t in texts:
+        importance = np.array([found.get(int(r), (None, None))[1] for r in rids], dtype=np.float64)
 
-            v = np.zeros(DEFAULT_DIM, dtype=np.float32)
+        importance = np.where(np.isnan(importance), DEFAULT_IMPORTANCE, importance)
 
-            for i, ch in enumerate(t[:DEFAULT_DIM]):
+        age = np.maximum(time.time() - created, 0.0)
 
-                v[i] = (ord(ch) % 100) / 100.0
+        decay = np.nan_to_num(np.exp2(-age / (half_life_days * 86400.0)), nan=0.0)
 
-            vecs.append(v)
+        span = float(scores.max() - scores.min())
 
-        return _normalize(np.vstack(vecs))
+        relevance = (scores - scores.min()) / span if span > 0 else np.ones(len(scores))
 
+        final = relevance + RECENCY_WEIGHT * decay + IMPORTANCE_WEIGHT * importance
 
+        top = np.argsort(-final, kind="stable")[:k]
 
-    @property
+        return rids[top], final[top].astype(np.float32)
 
-    def dim(self) -> int:
 
-        return int(self._dim)
 
+    def _filter_rids(self, where: Tuple[str, List[Any]]) -> Optional[np.ndarray]:
 
+        clause, params = where
 
-              
+        if not clause:
 
-class MemoryRAG:
+            return None
 
-    def __init__(self, sqlite_path: Path = SQLITE_PATH, embedder: Optional[Embedder] = None, faiss_index_path: Optional[Path] = FAISS_INDEX_PATH):
+        rows = self._conn().execute(f"SELECT rid FROM memories WHERE {clause} ORDER BY rid", params)
 
-        self.sqlite_path = sqlite_path
+        return np.fromiter((r[0] for r in rows), dtype=np.int64)
 
-        self.embedder = embedder or Embedder()
 
-        self.faiss_index_path = faiss_index_path
 
-        self.lock = threading.RLock()
+    def _fuse(self, rankings: List[np.ndarray], k: int) -> Tuple[np.ndarray, np.ndarray]:
 
-        self._init_db()
+        fused: Dict[int, float] = {}
 
-        self._meta: List[MemoryEntry] = []
+        for ranking in rankings:
 
-        self._load_meta()
+            for rank, rid in enumerate(ranking):
 
-        self._index = None
+                fused[int(rid)] = fused.get(int(rid), 0.0) + 1.0 / (RRF_K + rank + 1)
 
-        self._dim = self.embedder.dim or DEFAULT_DIM
+        top = sorted(fused.items(), key=lambda kv: -kv[1])[:k]
 
-        self._init_faiss()
+        return np.array([r for r, _ in top], dtype=np.int64), np.array([s for _, s in top], dtype=np.float32)
 
 
 
-    def _init_db(self):
+    def _lexical_candidates(self, query: str, k: int, where: Tuple[str, List[Any]] = ("", []), match_all: bool = False,
 
-        with sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT) as conn:
+                            max_terms: int = FTS_MAX_TERMS) -> Tuple[np.ndarray, np.ndarray]:
 
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS memories (
-                    id TEXT PRIMARY KEY,
-                    text TEXT NOT NULL,
-                    tags TEXT,
-                    created_at TEXT,
-                    embedding_b64 TEXT,
-                    embedding_model TEXT
-                );
-            """)
+        expr, terms = _fts_query(query, match_all)
 
-            conn.commit()
+        if not terms or terms > max_terms:
 
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
 
+        clause, params = where
 
-    def _load_meta(self):
+        restrict = f" AND rowid IN (SELECT rid FROM memories WHERE {clause})" if clause else ""
 
-        with self.lock:
+        rows = self._conn().execute(
 
-            with sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT) as conn:
+            f"SELECT rowid, bm25(memories_fts) FROM memories_fts WHERE memories_fts MATCH ?{restrict} ORDER BY bm25(memories_fts) LIMIT ?",
 
-                cur = conn.execute("SELECT id, text, tags, created_at, embedding_b64, embedding_model FROM memories ORDER BY created_at ASC")
+            [expr, *params, k]
 
-                rows = cur.fetchall()
+        ).fetchall()
 
-            self._meta = []
+        return np.array([r[0] for r in rows], dtype=np.int64), -np.array([r[1] for r in rows], dtype=np.float32)
 
-            for r in rows:
 
-                tags = json.loads(r[2]) if r[2] else []
 
-                self._meta.append(MemoryEntry(id=r[0], text=r[1], tags=tags, created_at=r[3], embedding_b64=r[4], embedding_model=r[5]))
+    def _search_vec(self, qvec: np.ndarray, k: int, allowed: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
 
-            if self._meta and self._meta[0].embedding_b64:
+        return self._hits(*self._vector_candidates(qvec, k, allowed))
 
-                self._dim = int(_b64_to_float32(self._meta[0].embedding_b64).shape[0])
 
 
+    def _vector_candidates(self, qvec: np.ndarray, k: int, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
 
-    def _init_faiss(self):
+        return self._vector_candidates_many(np.expand_dims(np.asarray(qvec, dtype=np.float32), 0), k, allowed)[0]
 
-        with self.lock:
 
-            self._index = None
 
-            if not FAISS_AVAILABLE or not self._meta:
+    def _vector_candidates_many(self, qvecs: np.ndarray, k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
 
-                return
+        qvecs = np.atleast_2d(np.asarray(qvecs, dtype=np.float32))
 
-            try:
+        empty = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))] * len(qvecs)
+
+        if len(qvecs) == 0 or k <= 0:
+
+            return empty
 
-                if self.faiss_index_path.exists():
+        with self.lock:
+
+            if allowed is not None and len(allowed) <= FILTER_EXACT_ROWS:
 
-                    self._index = faiss.read_index(str(self.faiss_index_path))
+                if self._quantized:
+
+                    rids, vecs = allowed, self._fetch_vectors(allowed)
 
                 else:
 
-                    self._index = faiss.IndexFlatIP(self._dim)
+                    pos = self._positions(allowed)
 
-                    arr = np.vstack([_b64_to_float32(m.embedding_b64) for m in self._meta]).astype("float32")
+                    pos = pos[pos >= 0]
 
-                    self._index.add(arr)
+                    rids, vecs = self._rids[pos], self._vectors[pos]
 
-                    faiss.write_index(self._index, str(self.faiss_index_path))
+                return _top_rows(qvecs @ vecs.T, rids, k) if len(rids) else empty
 
-            except Exception:
+            if FAISS_AVAILABLE and self._index is not None:
 
-                self._index = None
+                try:
 
+                    rerank = self.index_config.rerank if _index_quantizer(self._index) != "none" else 0
 
+                    D, I = self._index_search(qvecs, k * rerank if rerank > 1 else k, allowed)
 
-    def _save_faiss(self):
+                    if rerank:
 
-        if FAISS_AVAILABLE and self._index and self.faiss_index_path:
+                        uniq = np.unique(I[I >= 0])
 
-            try:
+                        exact = self._fetch_vectors(uniq)
 
-                faiss.write_index(self._index, str(self.faiss_index_path))
+                    out = []
 
-            except Exception:
+                    for row in range(len(qvecs)):
 
-                pass
+                        keep = I[row] >= 0
 
+                        scores, rids = D[row][keep], I[row][keep]
 
+                        if rerank:
 
-    def add_memory(self, text: str, tags: Optional[List[str]] = None, meta: Optional[Dict[str, Any]] = None) -> MemoryEntry:
+                            scores = exact[np.searchsorted(uniq, rids)] @ qvecs[row]
 
-        tags = tags or []
+                            top = np.argsort(-scores)[:k]
 
-        meta = meta or {}
+                            scores, rids = scores[top], rids[top]
 
-        mid = meta.get("id") or str(uuid.uuid4())
+                        out.append((rids, scores))
 
-        created_at = meta.get("created_at") or datetime.now(timezone.utc).isoformat()
+                    if allowed is None or all(len(rids) >= min(k, len(allowed)) for rids, _ in out):
 
-        vec = self.embedder.embed_texts([text])[0]
+                        return out
 
-        b64 = _float32_to_b64(vec)
+                except Exception:
 
-        entry = MemoryEntry(
+                    pass
 
-            id=mid, text=text, tags=tags, created_at=created_at,
+            n = self._n
 
-            embedding_b64=b64, embedding_model=self.embedder.model_used                      
+            if n == 0:
 
-        )
+                return empty
 
-        with self.lock:
+            if self._quantized:
 
-            with sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT) as conn:
+                return self._scan_search(qvecs, k, allowed)
 
-                conn.execute(
+            blocked = None
 
-                    "INSERT OR REPLACE INTO memories (id, text, tags, created_at, embedding_b64, embedding_model) VALUES (?, ?, ?, ?, ?, ?)",
+            if allowed is not None:
 
-                    (entry.id, entry.text, json.dumps(entry.tags), entry.created_at, entry.embedding_b64, entry.embedding_model)
+                pos = self._positions(allowed)
 
-                )
+                blocked = np.ones(n, dtype=bool)
 
-                conn.commit()
+                blocked[pos[pos >= 0]] = False
 
-            self._meta.append(entry)
+            out = []
 
-            if FAISS_AVAILABLE:
+            step = max(1, VECTOR_SCAN_CELLS // n)
 
-                try:
+            for i in range(0, len(qvecs), step):
 
-                    if self._index is None:
+                scores = qvecs[i:i + step] @ self._vectors.T
 
-                        self._dim = int(vec.shape[0])
+                if blocked is not None:
 
-                        self._index = faiss.IndexFlatIP(self._dim)
+                    scores[:, blocked] = -np.inf
 
-                    self._index.add(np.expand_dims(vec, 0))
+                out.extend(_top_rows(scores, self._rids, k))
 
-                    self._save_faiss()
+            return out
 
-                except Exception:
 
-                    pass
 
-        log_action("memory_add", {"id": mid, "len": len(text)})
+    def _scan_search(self, qvecs: np.ndarray, k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
 
-        return entry
+        best_scores = np.zeros((len(qvecs), 0), dtype=np.float32)
 
+        best_rids = np.zeros((len(qvecs), 0), dtype=np.int64)
 
+        for ids, mat in self._iter_vectors():
 
-    def list_memories(self, limit: int = 200) -> List[Dict[str, Any]]:
+            if allowed is not None:
 
-        with self.lock:
+                keep = np.isin(ids, allowed)
 
-            return [m.to_dict() for m in self._meta[-limit:][::-1]]                           
+                ids, mat = ids[keep], mat[keep]
 
+            best_scores = np.concatenate([best_scores, qvecs @ mat.T], axis=1)
 
+            best_rids = np.concatenate([best_rids, np.broadcast_to(ids, (len(qvecs), len(ids)))], axis=1)
 
-    def search(self, query: str, k: int = 6) -> List[Dict[str, Any]]:
+            if best_scores.shape[1] > k:
 
-        qvec = self.embedder.embed_texts([query])[0]
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
 
-        with self.lock:
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
 
-            if FAISS_AVAILABLE and self._index:
+                best_rids = np.take_along_axis(best_rids, keep, axis=1)
 
-                try:
+        order = np.argsort(-best_scores, axis=1)
 
-                    D, I = self._index.search(np.expand_dims(qvec, 0), k)
+        return [(best_rids[row][order[row]], best_scores[row][order[row]]) for row in range(len(qvecs))]
 
-                    return [
 
-                        {"id": self._meta[idx].id, "text": self._meta[idx].text, "tags": self._meta[idx].tags,
 
-                         "created_at": self._meta[idx].created_at, "score": float(score)}
+    def _hits(self, rids: np.ndarray, scores: np.ndarray) -> List[Dict[str, Any]]:
 
-                        for score, idx in zip(D[0], I[0]) if 0 <= idx < len(self._meta)
+        return self._hits_many([(rids, scores)])[0]
 
-                    ]
 
-                except Exception:
 
-                    pass
+    def _hits_many(self, ranked: List[Tuple[np.ndarray, np.ndarray]]) -> List[List[Dict[str, Any]]]:
 
-            scored = [(float(np.dot(_b64_to_float32(m.embedding_b64), qvec)), m) for m in self._meta if m.embedding_b64]
+        with self.lock:
 
-            scored.sort(key=lambda x: x[0], reverse=True)
+            rows = self._entries(np.unique(np.concatenate([rids for rids, _ in ranked]).astype(np.int64)))
 
-            return [{"id": m.id, "text": m.text, "tags": m.tags, "created_at": m.created_at, "score": score}
+        return [[{"id": m.id, "text": m.text, "tags": m.tags, "created_at": m.created_at, "score": float(s)}
 
-                    for score, m in scored[:k]]
+                 for m, s in ((rows.get(int(r)), s) for r, s in zip(rids, scores)) if m is not None] for rids, scores in ranked]
 
 
 
@@ -467,27 +3816,25 @@ class MemoryRAG:
 
         from sqlite3 import OperationalError
 
-        with self.lock:
+        with self._write_lock:
 
             try:
 
-                with sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT) as conn:
+                with self._write() as conn:
 
                     cur = conn.cursor()
 
-                    cur.execute("DELETE FROM memories WHERE id = ?", (memory_id,))
+                    row = cur.execute("SELECT rid FROM memories WHERE id = ?", (memory_id,)).fetchone()
 
-                    conn.commit()
+                    cur.execute("DELETE FROM memories WHERE id = ?", (memory_id,))
 
                     deleted = cur.rowcount > 0
 
                 if deleted:
 
-                    self._load_meta()
-
-                    if FAISS_AVAILABLE:
+                    with self.lock:
 
-                        self._init_faiss()
+                        self._drop_rids([row[0]])
 
                     log_action("memory_delete", {"id": memory_id})
 
@@ -509,45 +3856,67 @@ class MemoryRAG:
 
     def delete_by_text(self, substring: str, limit: Optional[int] = None) -> int:
 
-        substring = substring.lower()
+        return self.delete_where(substring=substring, limit=limit)
+
 
-        with self.lock:
 
-            ids_to_delete = [m.id for m in self._meta if substring in m.text.lower()]
+    def delete_where(self, substring: Optional[str] = None, tags: Optional[List[str]] = None, since: Any = None, until: Any = None,
 
-            if limit:
+                     ids: Optional[List[str]] = None, limit: Optional[int] = None, dry_run: bool = False) -> int:
 
-                ids_to_delete = ids_to_delete[:limit]
+        clause, params = _filter_sql(tags, since, until)
 
-            if not ids_to_delete:
+        clauses = [clause] if clause else []
+
+        if substring:
+
+            clauses.append("instr(py_lower(text), ?) > 0")
+
+            params.append(substring.lower())
+
+        if ids is not None:
+
+            if not ids:
 
                 return 0
 
-            deleted_count = 0
+            clauses.append(f"id IN ({','.join('?' * len(ids))})")
 
-            try:
+            params.extend(ids)
 
-                with sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT) as conn:
+        if not clauses:
 
-                    cur = conn.cursor()
+            raise ValueError("delete_where needs at least one predicate")
 
-                    for _id in ids_to_delete:
+        query = f"SELECT rid FROM memories WHERE {' AND '.join(clauses)} ORDER BY rid LIMIT ?"
 
-                        cur.execute("DELETE FROM memories WHERE id = ?", (_id,))
+        params.append(limit if limit is not None else -1)
 
-                        deleted_count += cur.rowcount
+        if dry_run:
 
-                    conn.commit()
+            return len(self._conn().execute(query, params).fetchall())
 
-                self._load_meta()
+        with self._write_lock:
 
-                if FAISS_AVAILABLE:
+            try:
+
+                with self._write() as conn:
+
+                    rids = [r[0] for r in conn.execute(query, params)]
+
+                    conn.executemany("DELETE FROM memories WHERE rid = ?", [(r,) for r in rids])
+
+                if rids:
+
+                    with self.lock:
+
+                        self._drop_rids(rids)
 
-                    self._init_faiss()
+                log_action("memory_delete_batch", {"count": len(rids), "substring": (substring or "")[:20], "tags": tags or [],
 
-                log_action("memory_delete_batch", {"count": deleted_count, "substring": substring[:20]})
+                                                   "ids": len(ids or [])})
 
-                return deleted_count
+                return len(rids)
 
             except Exception as e:
 
@@ -559,25 +3928,31 @@ class MemoryRAG:
 
     def delete_all(self) -> int:
 
-        with self.lock:
+        with self._write_lock:
 
-            n = len(self._meta)
+            n = self._n
 
             try:
 
-                with sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT) as conn:
+                with self._write() as conn:
 
-                    cur = conn.cursor()
+                    conn.execute("DELETE FROM memories")
 
-                    cur.execute("DELETE FROM memories")
+                with self.lock:
 
-                    conn.commit()
+                    self._cache.clear()
 
-                self._load_meta()
+                    self._set_rows(self._rids[:0], self._vectors[:0])
 
-                if FAISS_AVAILABLE:
+                    self._rebuild_delta = None
 
-                    self._init_faiss()
+                    if self._index is not None:
+
+                        self._index.reset()
+
+                        self._dead_labels = set()
+
+                        self._save_faiss()
 
                 log_action("memory_delete_all", {"count": n})
 
@@ -593,9 +3968,9 @@ class MemoryRAG:
 
     def reembed_all(self, batch_size: int = 128, updater: Optional[Callable[[int, int], None]] = None) -> Dict[str, Any]:
 
-        with self.lock:
+        with self._write_lock:
 
-            total = len(self._meta)
+            total = self._n
 
             if total == 0:
 
@@ -611,39 +3986,39 @@ class MemoryRAG:
 
                 backup_path = None
 
-            ids, texts = [m.id for m in self._meta], [m.text for m in self._meta]
+            processed, last = 0, -1
 
-            processed = 0
+            while True:
 
-            for i in range(0, total, batch_size):
+                rows = self._conn().execute("SELECT rid, text FROM memories WHERE rid > ? ORDER BY rid LIMIT ?", (last, batch_size)).fetchall()
 
-                batch_texts = texts[i:i + batch_size]
+                if not rows:
 
-                emb_batch = self.embedder.embed_texts(batch_texts)
+                    break
 
-                with sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT) as conn:
+                last = rows[-1][0]
 
-                    cur = conn.cursor()
-
-                    for j, emb in enumerate(emb_batch):
+                emb_batch = self.embedder.embed_texts([r[1] for r in rows])
 
-                        b64 = _float32_to_b64(emb)
+                with self._write() as conn:
 
-                        cur.execute("UPDATE memories SET embedding_b64 = ?, embedding_model = ? WHERE id = ?",
+                    conn.executemany("UPDATE memories SET embedding = ?, embedding_model = ? WHERE rid = ?",
 
-                                    (b64, self.embedder.model_used, ids[i + j]))
+                                     [(_float32_to_blob(emb), self.embedder.model_used, r[0]) for r, emb in zip(rows, emb_batch)])
 
-                        processed += 1
+                    processed += len(emb_batch)
 
                 if updater:
 
                     updater(processed, total)
 
-            self._load_meta()
+            with self.lock:
+
+                self._load_meta()
 
-            if FAISS_AVAILABLE:
+                if FAISS_AVAILABLE:
 
-                self._init_faiss()
+                    self._init_faiss(rebuild=True)
 
             log_action("memory_reembed", {"count": processed})
 
@@ -653,9 +4028,9 @@ class MemoryRAG:
 
     def summarize_and_compact(self, max_entries: int = 1000, summarizer: Optional[Callable[[List[str]], str]] = None) -> Dict[str, Any]:
 
-        with self.lock:
+        with self._write_lock:
 
-            n = len(self._meta)
+            n = self._n
 
             if n <= max_entries:
 
@@ -663,7 +4038,9 @@ class MemoryRAG:
 
             remove_count = max(1, n - (max_entries // 2))
 
-            to_summarize = [m.text for m in self._meta[:remove_count]]
+            oldest = self._conn().execute("SELECT rid, text FROM memories ORDER BY rid LIMIT ?", (remove_count,)).fetchall()
+
+            to_summarize = [r[1] for r in oldest]
 
             if summarizer:
 
@@ -687,35 +4064,33 @@ class MemoryRAG:
 
             vec = self.embedder.embed_texts([summary_text])[0]
 
-            b64 = _float32_to_b64(vec)
-
             tags = ["summary", f"compacted_from_{remove_count}"]
 
-            with sqlite3.connect(self.sqlite_path, timeout=SQLITE_TIMEOUT) as conn:
+            with self._write() as conn:
 
                 cur = conn.cursor()
 
-                cur.execute("BEGIN")
+                cur.executemany("DELETE FROM memories WHERE rid = ?", [(r[0],) for r in oldest])
 
-                for _id in [m.id for m in self._meta[:remove_count]]:
+                cur.execute("INSERT INTO memories (id, text, tags, created_at, embedding, embedding_model, created_ts, text_hash) "
 
-                    cur.execute("DELETE FROM memories WHERE id = ?", (_id,))
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
 
-                cur.execute("INSERT INTO memories (id, text, tags, created_at, embedding_b64, embedding_model) VALUES (?, ?, ?, ?, ?, ?)",
+                            (summary_id, summary_text, json.dumps(tags), created_at, _float32_to_blob(vec), self.embedder.model_used,
 
-                            (summary_id, summary_text, json.dumps(tags), created_at, b64, self.embedder.model_used))
+                             _created_ts(created_at), text_key(summary_text)))
 
-                conn.commit()
+            with self.lock:
 
-            self._load_meta()
+                self._load_meta()
 
-            if FAISS_AVAILABLE:
+                if FAISS_AVAILABLE:
 
-                self._init_faiss()
+                    self._init_faiss(rebuild=True)
 
-            log_action("memory_compact", {"removed": remove_count, "new_count": len(self._meta)})
+            log_action("memory_compact", {"removed": remove_count, "new_count": self._n})
 
-            return {"ok": True, "compacted": remove_count, "new_count": len(self._meta)}
+            return {"ok": True, "compacted": remove_count, "new_count": self._n}
 
 
 
@@ -735,6 +4110,150 @@ if __name__ == "__main__":
 
                                            
 
+    b = sub.add_parser("bench", help="insert/delete throughput on a scratch store")
+
+    b.add_argument("--n", type=int, default=2000)
+
+    b.add_argument("--no-faiss", action="store_true")
+
+    rc = sub.add_parser("recall", help="recall@k and index bytes per vector for each quantizer on clustered synthetic data")
+
+    rc.add_argument("--n", type=int, default=50000)
+
+    rc.add_argument("--k", type=int, default=10)
+
+    rc.add_argument("--queries", type=int, default=200)
+
+    rc.add_argument("--index", default="flat", choices=INDEX_KINDS)
+
     args = p.parse_args()
 
-                                     
+    if args.cmd == "bench":
+
+        import tempfile
+
+
+
+        class _RandomEmbedder(Embedder):
+
+            def __init__(self):
+
+                super().__init__(service_url="")
+
+                self._rng = np.random.default_rng(0)
+
+
+
+            def embed_texts(self, texts: List[str], timeout: int = 60) -> np.ndarray:
+
+                return _normalize(self._rng.standard_normal((len(texts), DEFAULT_DIM)).astype(np.float32))
+
+
+
+        if args.no_faiss:
+
+            FAISS_AVAILABLE = False
+
+        tmp = Path(tempfile.mkdtemp(prefix="memory_rag_bench_"))
+
+        rag = MemoryRAG(sqlite_path=tmp / "bench.sqlite", embedder=_RandomEmbedder(), faiss_index_path=tmp / "bench.index")
+
+        t0 = time.perf_counter()
+
+        for i in range(args.n):
+
+            rag.add_memory(f"bench memory {i}", meta={"id": f"bench-{i}"})
+
+        t_add = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+
+        for i in range(0, args.n, 4):
+
+            rag.delete_memory(f"bench-{i}")
+
+        t_del = time.perf_counter() - t0
+
+        rag.close()
+
+        shutil.rmtree(tmp, ignore_errors=True)
+
+        pprint.pprint({"n": args.n, "faiss": FAISS_AVAILABLE, "inserts_per_s": round(args.n / t_add, 1),
+
+                       "deletes_per_s": round(len(range(0, args.n, 4)) / t_del, 1)})
+
+    elif args.cmd == "recall":
+
+        import tempfile
+
+        rng = np.random.default_rng(0)
+
+        centers = rng.standard_normal((max(8, args.n // 500), DEFAULT_DIM)).astype(np.float32)
+
+        data = _normalize(centers[rng.integers(0, len(centers), args.n)] + 0.35 * rng.standard_normal((args.n, DEFAULT_DIM)).astype(np.float32))
+
+        queries = _normalize(data[rng.integers(0, args.n, args.queries)] + 0.1 * rng.standard_normal((args.queries, DEFAULT_DIM)).astype(np.float32))
+
+        truth = np.argsort(-(queries @ data.T), axis=1)[:, :args.k]
+
+
+
+        class _FixedEmbedder(Embedder):
+
+            def __init__(self):
+
+                super().__init__(service_url="")
+
+                self._next = 0
+
+
+
+            def embed_texts(self, texts: List[str], timeout: int = 60) -> np.ndarray:
+
+                out = data[self._next:self._next + len(texts)]
+
+                self._next += len(texts)
+
+                return out
+
+
+
+        report = []
+
+        for quant in INDEX_QUANTIZERS:
+
+            tmp = Path(tempfile.mkdtemp(prefix="memory_rag_recall_"))
+
+            cfg = IndexConfig(mode=args.index, quantizer=quant, pq_min_rows=0)
+
+            rag = MemoryRAG(sqlite_path=tmp / "recall.sqlite", embedder=_FixedEmbedder(), faiss_index_path=tmp / "recall.index", index_config=cfg)
+
+            rag.add_memories([f"m{i}" for i in range(args.n)], batch_size=4096)
+
+            rag._save_faiss()
+
+            for rerank in ((0, cfg.rerank) if quant != "none" else (0,)):
+
+                rag.index_config.rerank = rerank
+
+                t0 = time.perf_counter()
+
+                hits = [[int(h["text"][1:]) for h in rag._search_vec(q, args.k)] for q in queries]
+
+                dt = time.perf_counter() - t0
+
+                recall = np.mean([len(set(h) & set(t.tolist())) / args.k for h, t in zip(hits, truth)])
+
+                report.append({"quantizer": quant, "rerank": rerank, f"recall@{args.k}": round(float(recall), 4),
+
+                               "ms_per_query": round(1000 * dt / len(queries), 3),
+
+                               "index_bytes_per_vector": round(os.path.getsize(tmp / "recall.index") / args.n, 1),
+
+                               "resident_bytes_per_vector": rag._vec_buf.shape[1] * 4})
+
+            rag.close()
+
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        pprint.pprint({"n": args.n, "index": args.index, "results": report})
@@ -98,6 +98,8 @@ DEFAULT_PERSONALITY: Dict[str, Any] = {
 
     "memory_style": "permanent (summarize/condense older entries periodically)",
 
+    "memory_half_life_days": 14,
+
     "dreams_and_imagination": True,
 
     "emotional_growth": True,